@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Check that the sprintly tool parses each git configuration file at most once
+a run, however many configuration keys it looks up.
+
+The sprintly scenarios of run.py are run once each in its setting, with the
+system and XDG configuration files kept out of it, so that the repository's
+configuration and the home directory's are the only ones there are. The
+number of configuration files parsed is read from the timings each run logs
+with SPRINTLY_PROFILE=log. Exits with status 1 if any run parses more files
+than there are, or logs no timings.
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from run import Bench, SCENARIOS, SPRINTLY_PATH, addServerOptions
+
+# the repository's configuration and ~/.gitconfig
+CONFIG_FILES = 2
+
+
+class ConfigBench(Bench):
+    def getEnv(self):
+        return dict(Bench.getEnv(self), XDG_CONFIG_HOME=os.path.join(self.home, '.config'), GIT_CONFIG_NOSYSTEM='1', SPRINTLY_PROFILE='log')
+
+    def countReads(self, command):
+        """
+        Run the command once and return the number of configuration files it
+        parsed, or None if it logged no timings.
+        """
+
+        logPath = os.path.join(self.home, '.sprintly', 'timings.log')
+        if os.path.exists(logPath):
+            os.remove(logPath)
+        self.measure(command, None)
+        if not os.path.exists(logPath):
+            return None
+
+        # a refresh the run started in the background logs its own timings,
+        # under other arguments
+        for line in open(logPath):
+            record = json.loads(line)
+            if record['argv'] == command:
+                return record['counts'].get('config files read', 0)
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check how many git configuration files a run of sprintly parses.')
+    addServerOptions(parser)
+    options = parser.parse_args()
+
+    failed = False
+    bench = ConfigBench(options)
+    try:
+        bench.setUp()
+        for name, command, message, state in SCENARIOS:
+            if command[0] != SPRINTLY_PATH:
+                continue
+            try:
+                bench.prepare(command, message, state)
+                reads = bench.countReads(command)
+            except Exception as e:
+                print 'FAIL: %s: %s' % (name, e)
+                failed = True
+                continue
+            if reads is None:
+                print 'FAIL: %s logged no timings' % name
+                failed = True
+                continue
+            print '%-36s %d config files read (at most %d)' % (name, reads, CONFIG_FILES)
+            if reads > CONFIG_FILES:
+                print 'FAIL: %s parsed the configuration more than once' % name
+                failed = True
+    finally:
+        bench.tearDown()
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
+
+# vim: et ts=4 sts=4 sw=4 tw=78 fo-=w
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Check the cold start cost of the commit-msg hook's fast path: importing
+sprintly and validating a message which already references an item.
+
+Each run is a fresh interpreter; the fastest of several runs, less the
+fastest run of an interpreter doing nothing, is compared against a budget.
+The heavy modules which only other code paths need must not be imported at
+all. Exits with status 1 if either check fails.
+"""
+
+import os
+import sys
+import subprocess
+import argparse
+from time import time
+
+HOOK_PATH = '''
+import sys
+import sprintly
+sprintly.SprintlyCommitHook().validate_message('Fix the widget; closes #12')
+sys.stdout.write(' '.join(sorted(sys.modules)))
+'''
+
+HEAVY_MODULES = ['dulwich', 'curses', 'httplib', 'urllib2', 'argparse', 'subprocess', 'shutil', 'logging', 'json', 'multiprocessing']
+
+
+def fastest(code, runs, env):
+    best = None
+    for i in range(runs):
+        start = time()
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the commit-msg hook path.')
+    parser.add_argument('--budget', type=float, default=15, help='allowed time in milliseconds over a bare interpreter (default 15)')
+    parser.add_argument('--runs', type=int, default=20, help='number of runs to take the fastest of')
+    options = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONDONTWRITEBYTECODE'] = ''
+
+    bare, _ = fastest('pass', options.runs, env)
+    hook, modules = fastest(HOOK_PATH, options.runs, env)
+    cost = (hook - bare) * 1000
+
+    failed = False
+    print 'hook path: %.1f ms over a bare interpreter (budget %.1f ms)' % (cost, options.budget)
+    if cost > options.budget:
+        print 'FAIL: over budget'
+        failed = True
+
+    modules = modules.split()
+    loaded = [heavy for heavy in HEAVY_MODULES if heavy in modules]
+    if loaded:
+        print 'FAIL: imported %s' % ', '.join(loaded)
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
+
+# vim: et ts=4 sts=4 sw=4 tw=78 fo-=w
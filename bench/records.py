@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Compare the memory and cache size of items kept as the API gives them with
+the same items kept as compact sprintly.Item records.
+
+Each way of holding the items is measured in a fresh interpreter, as the
+growth of its resident set size from decoding the items a page at a time, as
+they come from the API, and keeping them.
+"""
+
+import os
+import sys
+import json
+import resource
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sprintly
+from standin import makeFixture
+
+
+def fixtureItems(products, items):
+    return [item for product, productItems in makeFixture(products, items).values() for item in productItems]
+
+
+def residentSize():
+    """
+    Get the resident set size in kilobytes; where /proc is not available
+    this is the peak size, which is less telling.
+    """
+
+    try:
+        statm = open('/proc/self/statm').read().split()
+        return int(statm[1]) * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(kind, pages):
+    """
+    Decode the pages of serialized API items and keep them as the given
+    kind, then return the RSS growth in kilobytes.
+    """
+
+    before = residentSize()
+    items = []
+    for page in pages:
+        page = json.loads(page)
+        if kind == 'compact':
+            page = [sprintly.Item.fromAPI(item) for item in page]
+        items.extend(page)
+    return residentSize() - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare raw and compact item records.')
+    parser.add_argument('--products', type=int, default=40, help='number of products')
+    parser.add_argument('--items', type=int, default=1000, help='number of items per product')
+    parser.add_argument('--measure', choices=['raw', 'compact'], help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.measure:
+        print measure(options.measure, sys.stdin.read().splitlines())
+        return
+
+    items = fixtureItems(options.products, options.items)
+    serialized = json.dumps(items)
+    pages = '\n'.join(json.dumps(items[offset:offset + 100]) for offset in range(0, len(items), 100))
+
+    store = sprintly.ProductStore(None, [], {})
+    compact = store._encode({'items': [sprintly.Item.fromAPI(item) for item in items]})
+
+    print '%d items' % len(items)
+    print 'cache size: raw %.1f MB, compact %.1f MB' % (len(serialized) / 1e6, len(json.dumps(compact)) / 1e6)
+
+    memory = {}
+    for kind in ('raw', 'compact'):
+        process = subprocess.Popen([sys.executable, __file__, '--measure', kind], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        memory[kind] = int(process.communicate(pages)[0]) / 1024.0
+    print 'memory growth: raw %.1f MB, compact %.1f MB' % (memory['raw'], memory['compact'])
+
+if __name__ == '__main__':
+    main()
+
+# vim: et ts=4 sts=4 sw=4 tw=78 fo-=w
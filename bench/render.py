@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Time SprintlyTool.printList over a synthetic tree of items, with and
+without colour, writing to a stream which discards its output.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sprintly
+from standin import makeFixture
+
+
+class NullStream:
+    def __init__(self):
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+
+def makeProducts(products, items):
+    fixture = makeFixture(products, items)
+    return [dict(product, items=sprintly.ItemsTree(sprintly.Item.fromAPI(item) for item in productItems).getTree()) for product, productItems in fixture.values()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time printList over a synthetic tree of items.')
+    parser.add_argument('--products', type=int, default=10, help='number of products')
+    parser.add_argument('--items', type=int, default=1000, help='number of items per product')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs to take the fastest of')
+    options = parser.parse_args()
+
+    # run against a throwaway home directory holding just the credentials
+    home = tempfile.mkdtemp()
+    os.environ['HOME'] = home
+    config = open(os.path.join(home, '.gitconfig'), 'w')
+    config.write('[sprintly]\n\tuser = user@example.com\n\tkey = key\n')
+    config.close()
+
+    try:
+        products = makeProducts(options.products, options.items)
+        for colour in (False, True):
+            stream = NullStream()
+            sprintlyTool = sprintly.SprintlyTool(stream)
+            sprintlyTool._has_color = colour
+            sprintlyTool._cols = 80
+            sprintlyTool.getCache()['userId'] = {'user@example.com': 1}
+
+            best = None
+            for i in range(options.runs):
+                stream.writes = 0
+                start = time()
+                sprintlyTool.printList(products, 'anyone')
+                elapsed = time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            print '%s: %.1f ms for %d items (%.1f us each), %d writes' % ('colour' if colour else 'plain', best * 1000, options.products * options.items, best * 1e6 / (options.products * options.items), stream.writes)
+    finally:
+        shutil.rmtree(home)
+
+if __name__ == '__main__':
+    main()
+
+# vim: et ts=4 sts=4 sw=4 tw=78 fo-=w
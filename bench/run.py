@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Measure the sprintly tool and the commit-msg hook end to end against the
+stand-in API server, reporting for each scenario the median wall time, the
+requests made and response body bytes transferred, and the peak resident
+set size of the process.
+
+The server, a home directory with credentials and a git repository
+associated with product 1 are all set up afresh in a temporary directory,
+so nothing outside it is touched. Scenarios are run cold (with no cache) or
+warm (after a run which filled the cache), or warm with the agent running
+for the hook to ask. The hook is run in a pseudo-terminal and answers its
+prompt for an item number.
+
+Use --save to keep the results as a baseline and --baseline to compare a
+later run against it.
+"""
+
+import os
+import pty
+import sys
+import json
+import time
+import select
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib2
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STANDIN_PATH = os.path.join(PACKAGE_PATH, 'bench', 'standin.py')
+SPRINTLY_PATH = os.path.join(PACKAGE_PATH, 'sprintly')
+HOOK_PATH = os.path.join(PACKAGE_PATH, 'commit-msg')
+
+# name, command, commit message for the hook, and how to prepare each run:
+# 'cold' empties the cache, 'warm' fills it first and 'agent' also starts the
+# agent, once for all runs
+SCENARIOS = [
+    ('sprintly (cold)', [SPRINTLY_PATH], None, 'cold'),
+    ('sprintly (warm)', [SPRINTLY_PATH], None, 'warm'),
+    ('sprintly --all --anyone (cold)', [SPRINTLY_PATH, '--all', '--anyone'], None, 'cold'),
+    ('sprintly --all --anyone (warm)', [SPRINTLY_PATH, '--all', '--anyone'], None, 'warm'),
+    ('sprintly --all --anyone -f (warm)', [SPRINTLY_PATH, '--all', '--anyone', '--full-refresh'], None, 'warm'),
+    ('sprintly -c', [SPRINTLY_PATH, '-c'], None, 'warm'),
+    ('hook, prompting', [HOOK_PATH], 'Fix the widget', 'warm'),
+    ('hook, prompting, agent', [HOOK_PATH], 'Fix the widget caf\xc3\xa9', 'agent'),
+    ('hook, item in message', [HOOK_PATH], 'Fix the widget; closes #12', 'warm'),
+]
+
+
+class Bench:
+    def __init__(self, options):
+        self.options = options
+        self.root = tempfile.mkdtemp(prefix='sprintly-bench-')
+        self.home = os.path.join(self.root, 'home')
+        self.repo = os.path.join(self.root, 'repo')
+        self.server = None
+        self.apiUrl = None
+        self.agent = None
+
+    def setUp(self):
+        options = self.options
+        self.server = subprocess.Popen([sys.executable, STANDIN_PATH, '--port', '0', '--products', str(options.products), '--items', str(options.items), '--children', str(options.children), '--assignees', str(options.assignees), '--statuses', options.statuses, '--latency', str(options.latency), '--ratelimit', str(options.ratelimit)] + ([] if options.compression else ['--no-compression']), stderr=subprocess.PIPE)
+        port = int(self.server.stderr.readline().split()[-1])
+        self.apiUrl = 'http://localhost:%d/' % port
+
+        os.mkdir(self.home)
+        config = open(os.path.join(self.home, '.gitconfig'), 'w')
+        # the template is the default, but given so that the hook has to
+        # take it from the configuration
+        config.write('[sprintly]\n\tuser = user@example.com\n\tkey = key\n\tapiurl = %sapi/\n\ttemplate = %%(message)s; references %%(items)s\n' % self.apiUrl)
+        config.close()
+
+        env = self.getEnv()
+        subprocess.check_call(['git', 'init', '-q', self.repo], env=env)
+        subprocess.check_call(['git', 'config', 'sprintly.product', '1'], cwd=self.repo, env=env)
+
+    def tearDown(self):
+        self.stopAgent()
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+        shutil.rmtree(self.root, True)
+
+    def getEnv(self):
+        return dict(os.environ, HOME=self.home, PYTHONPATH=PACKAGE_PATH, TERM='dumb', LANG='C.UTF-8')
+
+    def getStats(self, path='_stats'):
+        return json.load(urllib2.urlopen(self.apiUrl + path))
+
+    def prepare(self, command, message, state):
+        if self.agent is None:
+            shutil.rmtree(os.path.join(self.home, '.sprintly'), True)
+        if state == 'warm' or state == 'agent' and self.agent is None:
+            devnull = open(os.devnull, 'w')
+            subprocess.check_call([sys.executable, SPRINTLY_PATH, '--refresh'] + command[1:], cwd=self.repo, env=self.getEnv(), stdout=devnull, stderr=devnull)
+            devnull.close()
+        if state == 'agent' and self.agent is None:
+            self.startAgent()
+        if message is not None:
+            messageFile = open(os.path.join(self.root, 'COMMIT_EDITMSG'), 'w')
+            messageFile.write(message)
+            messageFile.close()
+
+    def startAgent(self):
+        subprocess.check_call(['git', 'config', '--global', 'sprintly.agent', 'true'], env=self.getEnv())
+        devnull = open(os.devnull, 'w')
+        self.agent = subprocess.Popen([sys.executable, SPRINTLY_PATH, '--agent'], cwd=self.home, env=self.getEnv(), stdout=devnull, stderr=devnull)
+        devnull.close()
+        socketPath = os.path.join(self.home, '.sprintly', 'agent.sock')
+        while not os.path.exists(socketPath):
+            if self.agent.poll() is not None:
+                raise Exception('The agent exited with status %d' % self.agent.returncode)
+            time.sleep(0.01)
+
+    def stopAgent(self):
+        if self.agent is None:
+            return
+        self.agent.terminate()
+        self.agent.wait()
+        self.agent = None
+        subprocess.call(['git', 'config', '--global', '--unset', 'sprintly.agent'], env=self.getEnv())
+
+    def measure(self, command, message):
+        """
+        Run the command once and return its wall time in seconds and peak
+        RSS in kilobytes.
+        """
+
+        command = [sys.executable] + command
+        if message is not None:
+            command.append(os.path.join(self.root, 'COMMIT_EDITMSG'))
+
+        output = tempfile.TemporaryFile()
+        start = time.time()
+        if message is None:
+            process = subprocess.Popen(command, cwd=self.repo, env=self.getEnv(), stdout=output, stderr=subprocess.STDOUT)
+            pid = process.pid
+        else:
+            pid = self.spawnInTerminal(command, output)
+        _, status, usage = os.wait4(pid, 0)
+        elapsed = time.time() - start
+
+        if status != 0:
+            output.seek(0)
+            raise Exception('%s exited with status %d:\n%s' % (' '.join(command), status, output.read()))
+        return elapsed, usage.ru_maxrss
+
+    def spawnInTerminal(self, command, output):
+        """
+        Start the command in a pseudo-terminal, answer its prompt for item
+        numbers with an item assigned to nobody and copy its output to the
+        given file until it closes the terminal.
+        """
+
+        pid, fd = pty.fork()
+        if pid == 0:
+            os.chdir(self.repo)
+            os.execve(command[0], command, self.getEnv())
+
+        seen = ''
+        answered = False
+        while True:
+            ready, _, _ = select.select([fd], [], [], 60)
+            if not ready:
+                raise Exception('No output from %s' % ' '.join(command))
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            output.write(data)
+            seen = seen[-100:] + data
+            if not answered and 'Enter item numbers' in seen:
+                os.write(fd, '12\n')
+                answered = True
+        os.close(fd)
+        return pid
+
+    def run(self, scenarios):
+        results = []
+        for name, command, message, state in scenarios:
+            times = []
+            peak = 0
+            for i in range(self.options.runs):
+                self.prepare(command, message, state)
+                self.getStats('_reset')
+                elapsed, rss = self.measure(command, message)
+                times.append(elapsed)
+                peak = max(peak, rss)
+            stats = self.getStats()
+            self.stopAgent()
+            times.sort()
+            results.append({
+                'scenario': name,
+                'wall_ms': times[len(times) // 2] * 1000,
+                'requests': stats['requests'],
+                'bytes': stats['bytes'],
+                'peak_rss_kb': peak,
+            })
+        return results
+
+
+def report(results, baseline=None):
+    baseline = dict((result['scenario'], result) for result in baseline or [])
+    print '%-36s %10s %9s %11s %12s' % ('scenario', 'wall ms', 'requests', 'bytes', 'peak RSS MB')
+    for result in results:
+        line = '%-36s %10.1f %9d %11d %12.1f' % (result['scenario'], result['wall_ms'], result['requests'], result['bytes'], result['peak_rss_kb'] / 1024.0)
+        before = baseline.get(result['scenario'])
+        if before is not None and before['wall_ms']:
+            line += '  (%+.0f%% wall)' % ((result['wall_ms'] / before['wall_ms'] - 1) * 100)
+        print line
+
+
+def addServerOptions(parser):
+    """
+    Add the options for what the stand-in server serves, and how, to the
+    given argument parser.
+    """
+
+    parser.add_argument('--products', type=int, default=10, help='number of products')
+    parser.add_argument('--items', type=int, default=250, help='number of items per product')
+    parser.add_argument('--children', type=int, default=3, help='make every Nth item a child of the one before (0 for none)')
+    parser.add_argument('--assignees', type=int, default=1, help='number of people items are assigned to')
+    parser.add_argument('--statuses', default='backlog,in-progress,completed,accepted', help='comma-separated statuses to give items in turn')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds the server waits before each API response')
+    parser.add_argument('--ratelimit', type=int, default=0, help='API requests the server allows in any second (0 for no limit)')
+    parser.add_argument('--no-compression', dest='compression', action='store_false', help='have the server send response bodies uncompressed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sprintly against a local stand-in API server.')
+    addServerOptions(parser)
+    parser.add_argument('--runs', type=int, default=5, help='number of runs of each scenario to take the median of')
+    parser.add_argument('--scenario', action='append', help='run only scenarios whose names contain this (may be repeated)')
+    parser.add_argument('--save', help='write the results to this file as JSON')
+    parser.add_argument('--baseline', help='compare wall times with results saved earlier')
+    options = parser.parse_args()
+
+    scenarios = [scenario for scenario in SCENARIOS if not options.scenario or any(part in scenario[0] for part in options.scenario)]
+
+    bench = Bench(options)
+    try:
+        bench.setUp()
+        results = bench.run(scenarios)
+    finally:
+        bench.tearDown()
+
+    baseline = None
+    if options.baseline:
+        baseline = json.load(open(options.baseline))['results']
+    report(results, baseline)
+
+    if options.save:
+        saved = open(options.save, 'w')
+        json.dump({'options': vars(options), 'results': results}, saved, indent=2, sort_keys=True)
+        saved.close()
+
+if __name__ == '__main__':
+    main()
+
+# vim: et ts=4 sts=4 sw=4 tw=78 fo-=w
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+A local stand-in for the parts of the Sprint.ly API used by the sprintly
+tool, for measuring it without touching sprint.ly.
+
+Point sprintly at it with
+
+    git config sprintly.apiurl http://localhost:8000/api/
+
+and read connection, request and response body byte counts from /_stats;
+/_reset sets them back to zero. Bodies are compressed with gzip or deflate
+when the request accepts either, unless --no-compression is given, and the
+bytes counted are those sent, with the JSON's own size counted as
+uncompressed.
+
+With --ratelimit, requests beyond that many in any second are refused with
+a 429 status and a Retry-After header, and counted as throttled.
+
+/_touch?product=1&number=2 marks an item as modified, optionally with a new
+title, status or assignee (an empty assigned_to unassigns it), to exercise
+incremental refreshes.
+
+Use --certfile (a PEM file holding both certificate and key) to serve HTTPS;
+the certificate then has to be trusted, for instance with SSL_CERT_FILE.
+"""
+
+import sys
+import zlib
+import json
+import hashlib
+import time
+import ssl
+import threading
+import argparse
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+USER = {'id': 1, 'email': 'user@example.com', 'first_name': 'Example', 'last_name': 'User'}
+STATUSES = ['backlog', 'in-progress', 'completed', 'accepted']
+
+
+def timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(1400000000 + seconds))
+
+
+def makeFixture(products, items, children=3, assignees=1, statuses=STATUSES):
+    """
+    Build a map of product ID to its list of items. Every children-th item
+    is a child of the item before it (none are if children is 0), odd
+    numbered items are assigned to each of the given number of people in
+    turn, the first being the user, and the given statuses go round in turn.
+    """
+
+    people = [USER] + [{'id': id, 'email': 'person%d@example.com' % id, 'first_name': 'Person', 'last_name': str(id)} for id in range(2, assignees + 1)]
+    fixture = {}
+    for productId in range(1, products + 1):
+        product = {'id': productId, 'name': 'Product %d' % productId}
+        productItems = []
+        for number in range(1, items + 1):
+            item = {
+                'number': number,
+                'title': 'Item %d of product %d' % (number, productId),
+                'type': ('story', 'task', 'defect', 'test')[number % 4],
+                'status': statuses[number % len(statuses)],
+                'assigned_to': people[number // 2 % len(people)] if number % 2 else None,
+                'product': product,
+                'last_modified': timestamp(number),
+            }
+            if children and number % children == 0 and productItems:
+                item['parent'] = dict(productItems[-1])
+            productItems.append(item)
+        fixture[productId] = (product, productItems)
+    return fixture
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.connections = 0
+        self.requests = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.uncompressed = 0
+
+    def count(self, attr, n=1):
+        with self.lock:
+            setattr(self, attr, getattr(self, attr) + n)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.stats.count('connections')
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        path = url.path.split('/')
+
+        if url.path == '/_stats':
+            stats = self.server.stats
+            return self.respond(200, {'connections': stats.connections, 'requests': stats.requests, 'throttled': stats.throttled, 'bytes': stats.bytes, 'uncompressed': stats.uncompressed})
+
+        if url.path == '/_reset':
+            with self.server.stats.lock:
+                self.server.stats.reset()
+            return self.respond(200, {})
+
+        if url.path == '/_touch':
+            product, items = self.server.fixture[int(query['product'])]
+            item = [item for item in items if item['number'] == int(query['number'])][0]
+            self.server.clock += 1
+            item['last_modified'] = timestamp(self.server.clock)
+            if 'title' in query:
+                item['title'] = query['title']
+            if 'assigned_to' in query:
+                item['assigned_to'] = USER if query['assigned_to'] else None
+            if 'status' in query:
+                item['status'] = query['status']
+            return self.respond(200, item)
+
+        self.server.stats.count('requests')
+        self.counted = True
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.server.admit():
+            self.server.stats.count('throttled')
+            return self.respond(429, {'code': 429, 'message': 'Too many requests'}, {'Retry-After': '1'})
+
+        if url.path == '/api/user/whoami.json':
+            return self.respond(200, USER)
+        if url.path == '/api/products.json':
+            return self.respond(200, [product for product, items in self.server.fixture.values()])
+        if len(path) == 5 and path[4] == 'items.json':
+            try:
+                product, items = self.server.fixture[int(path[3])]
+            except (ValueError, KeyError):
+                return self.respond(404, {'code': 404, 'message': 'Product not found'})
+            if 'assigned_to' in query:
+                if query['assigned_to']:
+                    items = [item for item in items if item['assigned_to'] and str(item['assigned_to']['id']) == query['assigned_to']]
+                else:
+                    items = [item for item in items if item['assigned_to'] is None]
+            for field in ('status', 'type'):
+                if query.get(field):
+                    values = query[field].split(',')
+                    items = [item for item in items if item[field] in values]
+            if query.get('order_by') == 'recent':
+                items = sorted(items, key=lambda item: item['last_modified'], reverse=True)
+            elif query.get('order_by') == 'oldest':
+                items = sorted(items, key=lambda item: item['number'])
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', 20))
+            return self.respond(200, items[offset:offset + limit])
+        self.respond(404, {'code': 404, 'message': 'Not found'})
+
+    def respond(self, status, data, headers={}):
+        body = json.dumps(data)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status = 304
+            body = ''
+        uncompressed = len(body)
+        encoding = self.getEncoding() if body else None
+        if encoding is not None:
+            # gzip has a header and trailer of its own around the deflate
+            # data; deflate in HTTP means the zlib format
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if getattr(self, 'counted', False):
+            self.server.stats.count('bytes', len(body))
+            self.server.stats.count('uncompressed', uncompressed)
+            self.counted = False
+
+    def getEncoding(self):
+        """
+        Get the compression to use for the response, gzip rather than deflate
+        if the request accepts both, or None.
+        """
+
+        if not self.server.compression:
+            return None
+        accepted = set()
+        for part in self.headers.get('Accept-Encoding', '').split(','):
+            params = part.split(';')
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    quality = float(value)
+            if quality > 0:
+                accepted.add(params[0].strip().lower())
+        for encoding in ('gzip', 'deflate'):
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # room for every parallel connection, so none waits on a dropped SYN
+    request_queue_size = 64
+
+    def __init__(self, address, fixture, latency=0, rateLimit=0, compression=True):
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.fixture = fixture
+        self.latency = latency
+        self.compression = compression
+        self.rateLimit = rateLimit
+        self.admitted = []
+        self.stats = Stats()
+        self.clock = max(len(items) for product, items in fixture.values())
+
+    def admit(self):
+        """
+        Tell whether another API request is within the rate limit, counting
+        it if so.
+        """
+
+        if not self.rateLimit:
+            return True
+        with self.stats.lock:
+            now = time.time()
+            self.admitted = [started for started in self.admitted if started > now - 1]
+            if len(self.admitted) >= self.rateLimit:
+                return False
+            self.admitted.append(now)
+            return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a stand-in Sprint.ly API.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--products', type=int, default=10, help='number of products')
+    parser.add_argument('--items', type=int, default=250, help='number of items per product')
+    parser.add_argument('--children', type=int, default=3, help='make every Nth item a child of the one before (0 for none)')
+    parser.add_argument('--assignees', type=int, default=1, help='number of people items are assigned to')
+    parser.add_argument('--statuses', default=','.join(STATUSES), help='comma-separated statuses to give items in turn')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds to wait before each API response')
+    parser.add_argument('--ratelimit', type=int, default=0, help='API requests allowed in any second (0 for no limit)')
+    parser.add_argument('--no-compression', dest='compression', action='store_false', help='never compress response bodies')
+    parser.add_argument('--certfile', help='serve HTTPS using this PEM certificate and key')
+    options = parser.parse_args()
+
+    fixture = makeFixture(options.products, options.items, options.children, options.assignees, options.statuses.split(','))
+    server = StandInServer(('localhost', options.port), fixture, options.latency / 1000.0, options.ratelimit, options.compression)
+    if options.certfile:
+        server.socket = ssl.wrap_socket(server.socket, certfile=options.certfile, server_side=True)
+    sys.stderr.write('Serving on port %d\n' % server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
+
+# vim: et ts=4 sts=4 sw=4 tw=78 fo-=w
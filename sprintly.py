@@ -1,30 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+# Only modules needed to check a commit message are imported here, so that
+# the commit-msg hook starts quickly; everything else is imported by the code
+# which uses it.
 import sys
 import os
-import locale
-import urllib2
-import json
-import shutil
-import subprocess
 import re
-import string
-import logging
-import dulwich.repo
-import dulwich.config
-from curses import setupterm, tigetstr, tigetnum, tparm
 from time import time
-import argparse
-
-# force utf-8 encoding
-reload(sys)
-sys.setdefaultencoding('utf-8')
-
-logging.basicConfig()
-logger = logging.getLogger(__name__)
 
 # constants
+API_URL = 'https://sprint.ly/api/'
 HOOK_NAME = 'commit-msg'
 HOOK_DIR = os.path.dirname(__file__)
 ORIGINAL_HOOK_SUFFIX = '.original'
@@ -32,8 +18,49 @@ ACTION_KEYWORDS = ['close', 'closes', 'closed', 'fix', 'fixed', 'fixes', 'addres
 ITEM_KEYWORDS = ['#', 'ticket:', 'issue:', 'item:', 'bug:']
 DEFAULT_TEMPLATE = '%(message)s; references %(items)s'
 DEFAULT_ITEM_KEYWORD = '#'
+DEFAULT_CONCURRENCY = 8
+DEFAULT_FULL_REFRESH = 24 * 60 * 60
+DEFAULT_MAX_STALE = 24 * 60 * 60
+DEFAULT_SNAPSHOTS = 4
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 20
+DEFAULT_DEADLINE = 30
+DEFAULT_RETRIES = 3
+DEFAULT_AGENT_REFRESH = 5 * 60
 
 # non-editable constants
+CACHE_VERSION = 5
+DELTA_PROBE_LIMIT = 10
+# the most items the API gives in a page, how many items consecutive pages of
+# a product share, and how many more items than a product had last time its
+# pages leave room for
+PAGE_SIZE = 100
+PAGE_OVERLAP = 5
+PAGE_MARGIN = 10
+# how many times a product's pages are all requested again when they don't
+# line up
+PAGE_ATTEMPTS = 3
+BACKGROUND_REFRESH_INTERVAL = 60
+# how stale a snapshot's last use may get before recording it is worth
+# rewriting the cache
+USED_AT_INTERVAL = 60 * 60
+# how many new commits a listing reads into the history index itself, rather
+# than leaving them to a refresh in the background
+HISTORY_FOREGROUND_LIMIT = 2000
+# how long the commit-msg hook waits for the agent to answer, and how long the
+# agent waits without a request before exiting
+AGENT_TIMEOUT = 2
+AGENT_IDLE_TIMEOUT = 8 * 60 * 60
+# the error given for a call to the API which got no usable response
+NO_RESPONSE = {'message': 'no response from Sprint.ly'}
+# statuses of API responses worth asking again for, after a pause which
+# doubles with each retry up to the maximum unless the response gives one; a
+# response asking for a longer pause than the maximum is taken as final
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30
+# how much of a response body is read from the connection at a time
+READ_CHUNK_SIZE = 64 * 1024
 HOOK_PATH = os.path.join(HOOK_DIR, HOOK_NAME)
 ORIGINAL_HOOK_NAME = HOOK_NAME + ORIGINAL_HOOK_SUFFIX
 
@@ -49,6 +76,19 @@ ATTRS = {
     'RESET': RESET, 'NORMAL': NORMAL, 'BOLD': BOLD, 'DIM': DIM, 'UNDERLINE': UNDERLINE, 'INVERT': INVERT, 'HIDDEN': HIDDEN
 }
 
+# ${ATTR} markup in rendered lines, and the escape sequences it becomes
+MARKUP = re.compile(r'\$\$|\${\w+}')
+ITEM_REFERENCE = re.compile(
+        r'\b' # word break
+        '(?:' + '|'.join(re.escape(kw) for kw in ACTION_KEYWORDS) + ')' # action keyword
+        ' ' # space
+        '((?:' + '|'.join(re.escape(kw) for kw in ITEM_KEYWORDS) + ')' # item keyword
+        r'\d+' # number
+        '(?:, ?(?:' + '|'.join(re.escape(kw) for kw in ITEM_KEYWORDS) + r')\d+)*)' # more after commas
+        r'\b' # word break
+        )
+ESCAPE_SEQUENCE = re.compile(r'\x1b.*?m')
+
 ITEM_COLORS = {
     'story': 'GREEN',
     'task': 'GREY',
@@ -56,6 +96,9 @@ ITEM_COLORS = {
     'test': 'CYAN'
 }
 
+# fields of each item record in the machine-readable output formats
+RECORD_FIELDS = ['product', 'product_name', 'number', 'type', 'status', 'title', 'assignee_id', 'assignee', 'parent']
+
 ITEM_STATUSES = {
     'backlog': "Backlog",
     'in-progress': "In Progress",
@@ -74,14 +117,22 @@ class SprintlyTool:
         Initialize instance variables.
         """
 
+        import locale
+        from curses import setupterm, tigetnum
+
+        # force utf-8 encoding
+        forceUTF8()
+
         # Set up terminal
         locale.setlocale(locale.LC_ALL, '')
         self._encoding = locale.getpreferredencoding()
 
         self._term = term_stream or sys.__stdout__
+        self._output = self._term
         self._is_tty = False
         self._has_color = False
         self._cols = 80
+        self._templates = {}
 
         if hasattr(term_stream, "isatty") and term_stream.isatty():
             try:
@@ -99,12 +150,28 @@ class SprintlyTool:
                 pass
 
         self._cache = None
+        self._cacheStamp = None
+        self._cacheChanged = False
         self._sprintlyDirectoryPath = None
         self._sprintlyCachePath = None
         self._repo = None
+        self._apiClient = None
+        self._pagePool = None
+        self._configValues = None
+        self._configStamps = None
+        self._commitIndex = None
+
+        # record how long each phase takes if SPRINTLY_PROFILE asks for it;
+        # --timings can only ask once initialization is over, so its
+        # duration is kept regardless
+        self._timings = getTimings()
+        started = time()
 
         # ensure that the ~/.sprintly/ folder exists, we have credentials, etc
-        self.initialize()
+        with self._timings.phase('initialize'):
+            self.initialize()
+
+        self._initializeTime = time() - started
 
     def getOptions(self, source=None):
         """
@@ -138,12 +205,40 @@ If this is present the hook won't prompt for an item number and instead will
 automatically remove the item number and run the message and item numbers
 through the template configured in the Git config at sprintly.template.
 '''
+        import argparse
+
+        def listOf(choices):
+            def parse(value):
+                values = value.split(',')
+                for value in values:
+                    if value not in choices:
+                        raise argparse.ArgumentTypeError('invalid choice: %r (choose from %s)' % (value, ', '.join(sorted(choices))))
+                return values
+            return parse
+
+        def positive(value):
+            value = int(value)
+            if value < 1:
+                raise argparse.ArgumentTypeError('must be at least 1')
+            return value
+
         parser = argparse.ArgumentParser(description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
         parser.add_argument('--all', dest='allProducts', help='show items for all products (default when not in a repository)', action='store_true', default=False)
         parser.add_argument('--self', '-s', dest='assignee', help='show only items assigned to you (default)', action='store_const', const='self', default='self')
         parser.add_argument('--anyone', '-a', dest='assignee', help='show items assigned to anyone (or unassigned)', action='store_const', const='anyone')
         parser.add_argument('--unassigned', '-u', dest='assignee', help='show only unassigned items', action='store_const', const='unassigned')
+        parser.add_argument('--status', dest='statuses', metavar='STATUS[,...]', help='show only items with these statuses: %s' % ', '.join(sorted(ITEM_STATUSES)), type=listOf(ITEM_STATUSES))
+        parser.add_argument('--type', dest='types', metavar='TYPE[,...]', help='show only items of these types: %s' % ', '.join(sorted(ITEM_COLORS)), type=listOf(ITEM_COLORS))
+        parser.add_argument('--limit', dest='limit', metavar='N', help='show only the N most recently modified items of each product', type=positive)
+        parser.add_argument('--limit-scope', dest='limitScope', help='apply --limit to each product (default) or to all products together', choices=['product', 'all'], default='product')
         parser.add_argument('--cached', '-c', dest='cached', help='load items and products from cache', action='store_true', default=False)
+        parser.add_argument('--full-refresh', '-f', dest='fullRefresh', help='fetch all items rather than only those changed since they were cached', action='store_true', default=False)
+        parser.add_argument('--format', dest='format', help='list items as text (default), or as records for other programs: a JSON array, newline-delimited JSON or tab-separated values, one record per line', choices=['text', 'json', 'ndjson', 'tsv'], default='text')
+        parser.add_argument('--timings', dest='timings', help='print how long each phase of the run took to standard error', action='store_true', default=False)
+        parser.add_argument('--refresh', dest='refreshOnly', help='update the cache without listing items', action='store_true', default=False)
+        parser.add_argument('--index-history', dest='indexHistoryOnly', help=argparse.SUPPRESS, action='store_true', default=False)
+        parser.add_argument('--agent', dest='agent', help='run the agent which keeps the cache ready for the commit-msg hook (see sprintly.agent)', action='store_true', default=False)
+        parser.add_argument('--stop-agent', dest='stopAgent', help='stop the agent if it is running', action='store_true', default=False)
         parser.add_argument('--install-hook', dest='installHook', help='install commit-msg hook in current git repository', action='store_true', default=False)
         parser.add_argument('--uninstall-hook', dest='uninstallHook', help='uninstall commit-msg hook in current git repository', action='store_true', default=False)
 
@@ -159,16 +254,34 @@ through the template configured in the Git config at sprintly.template.
             if self._repo is None:
                 options.allProducts = True
 
+            # keep messages out of machine-readable output
+            if options.format != 'text':
+                self._term = sys.stderr
+
+            if options.timings and not self._timings.enabled:
+                self._timings = Timings()
+                self._timings.add('initialize', self._initializeTime)
+
             # run the requested option
             if options.installHook:
                 self.installHook()
             elif options.uninstallHook:
                 self.uninstallHook()
+            elif options.refreshOnly:
+                self.populateProductsCache(options.assignee, options.fullRefresh, self.getFilters(options))
+                self.updateCommitIndex()
+            elif options.indexHistoryOnly:
+                self.updateCommitIndex()
+            elif options.agent:
+                SprintlyAgent(self).serve()
+            elif options.stopAgent:
+                SprintlyAgent.stop()
             else:
                 self.listSprintlyItems(options)
 
             # Write the cache
-            self.writeCache()
+            with self._timings.phase('writeCache'):
+                self.writeCache()
 
         except KeyboardInterrupt:
             die()
@@ -178,6 +291,8 @@ through the template configured in the Git config at sprintly.template.
         except Exception as e:
             self.cprint('Fatal error', attr=RED)
             raise
+        finally:
+            self._timings.finish()
 
     def initialize(self):
         """
@@ -196,7 +311,9 @@ through the template configured in the Git config at sprintly.template.
         self._sprintlyDirectoryPath = os.path.join(home, '.sprintly')
 
         # set the sprintly cache path
-        self._sprintlyCachePath = os.path.join(self._sprintlyDirectoryPath, 'sprintly.cache')
+        self._sprintlyCachePath = os.path.join(self._sprintlyDirectoryPath, 'cache')
+
+        import dulwich.repo
 
         # Find the root of this git repository
         root = '.'
@@ -232,9 +349,10 @@ through the template configured in the Git config at sprintly.template.
             self.cprint('  git config --global sprintly...')
             raise SprintlyException()
 
-    def createSprintlyConfig(self):
+    def createSprintlyConfig(self, products):
         """
-        Create the Sprint.ly config. Prompt user for all necessary values.
+        Create the Sprint.ly config. Prompt user for all necessary values,
+        choosing from the given products.
         """
 
         # Get git configuration
@@ -254,7 +372,7 @@ through the template configured in the Git config at sprintly.template.
         # Prompt user for default product if more than 1
         productMap = {}
 
-        for product in self.getCache()['products'].values():
+        for product in products.values():
             productId = str(product['id'])
             productMap[productId] = product
 
@@ -264,7 +382,7 @@ through the template configured in the Git config at sprintly.template.
         if productCount == 0:
             raise SprintlyException('It appears that you have no products associated with your Sprint.ly account. Add at least one and then try again.')
         elif productCount == 1:
-            productId = productMap.values()[0]
+            productId = productMap.keys()[0]
         else:
             # prompt user for a product until they enter one found in the map
             productList = ', '.join(['%d - %s' % (p['id'], p['name']) for p in productMap.values()])
@@ -278,18 +396,76 @@ through the template configured in the Git config at sprintly.template.
 
         # write config file if all is good
         config.write_to_path()
+        self._configStamps = None
 
     def getConfigValue(self, key):
         """
         Get a value from the sprintly section of the git configuration
         """
-        try:
-            # Get the config of this git repository
-            config = self._repo.get_config_stack()
-        except AttributeError:
-            # Get the global git config
-            config = dulwich.config.StackedConfig(dulwich.config.StackedConfig.default_backends())
-        return config.get('sprintly', key)
+        with self._timings.phase('config'):
+            return self._getConfigValues()[key.lower()]
+
+    def getConfigValues(self):
+        """
+        Get the whole sprintly section of the git configuration, as a map of
+        lower case key to value.
+        """
+        with self._timings.phase('config'):
+            return dict(self._getConfigValues())
+
+    def _getConfigValues(self):
+        """
+        Get the sprintly section of the git configuration as a map of lower
+        case key to value, merged from the files in git's order of precedence.
+        The files are parsed on first use and again only if they are other
+        files or one of them has been changed, created or removed since, going
+        by modification times and sizes.
+        """
+
+        paths = self._getConfigPaths()
+        stamps = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                stamps.append((stat.st_mtime, stat.st_size))
+            except OSError:
+                stamps.append(None)
+
+        if (paths, stamps) != self._configStamps:
+            import dulwich.config
+
+            # least important first, so that more important values replace them
+            values = {}
+            for path, stamp in reversed(zip(paths, stamps)):
+                if stamp is None:
+                    continue
+                try:
+                    config = dulwich.config.ConfigFile.from_path(path)
+                except (IOError, OSError):
+                    continue
+                self._timings.count('config files read')
+                if config.has_section(('sprintly',)):
+                    values.update((name.lower(), value) for name, value in config.iteritems(('sprintly',)))
+            self._configValues = values
+            self._configStamps = (paths, stamps)
+
+        return self._configValues
+
+    def _getConfigPaths(self):
+        """
+        Get the paths of the git configuration files which apply, most
+        important first: this repository's, if any, then those dulwich's
+        default config stack reads.
+        """
+
+        paths = []
+        if self._repo is not None:
+            paths.append(os.path.join(self._repo.controldir(), 'config'))
+        paths.append(os.path.expanduser('~/.gitconfig'))
+        paths.append(os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config/')), 'git', 'config'))
+        if 'GIT_CONFIG_NOSYSTEM' not in os.environ:
+            paths.append('/etc/gitconfig')
+        return paths
 
     def getUserId(self):
         """
@@ -304,6 +480,8 @@ through the template configured in the Git config at sprintly.template.
             pass
 
         response = self.sprintlyAPICall('user/whoami.json')
+        if response is False or response and response.get('code') in RETRY_STATUSES:
+            raise SprintlyException('Unable to reach Sprint.ly.')
         if not response or 'code' in response:
             raise SprintlyException('Invalid credentials. Unable to authenticate with Sprint.ly.')
         if response['email'] != self.getConfigValue('user'):
@@ -313,586 +491,2988 @@ through the template configured in the Git config at sprintly.template.
         if 'userId' not in cache:
             cache['userId'] = {}
         cache['userId'][self.getConfigValue('user')] = response['id']
+        self._cacheChanged = True
 
         return response['id']
 
     def listSprintlyItems(self, options):
         """
-        Lists all items for the current user from the Sprint.ly API.
+        Lists all items for the current user from the Sprint.ly API, showing
+        each product as soon as it has been fetched.
         """
 
-        if not options.cached:
-            # populate the cache from the API if possible (may not be possible,
-            # e.g. in the case of offline access)
-            self.populateProductsCache(options.assignee)
-
-        products = self.getCache()['products']
-        if options.allProducts:
-            # Dict to list
-            products = products.values()
-        else:
+        filters = self.getFilters(options)
+        refreshed = False
+        productId = None
+        if not options.allProducts:
             try:
                 productId = self.getConfigValue('product')
             except KeyError:
+                # get an up to date list of products to choose from
+                if not options.cached:
+                    self.populateProductsCache(options.assignee, options.fullRefresh, filters)
+                    refreshed = True
                 self.cprint('This git repository is not yet associated with a Sprint.ly product. You will now be prompted to choose one.', attr=YELLOW)
-                self.createSprintlyConfig()
+                self.createSprintlyConfig(self.getSnapshot(options.assignee, filters)['products'])
                 productId = self.getConfigValue('product')
-            products = [products[productId]]
+
+        if options.cached or refreshed:
+            snapshot = self.getSnapshot(options.assignee, filters)
+            if 'refreshed_at' not in snapshot:
+                raise SprintlyException('There are no cached items to show; run again without --cached.')
+            products = snapshot['products']
+            if productId is None:
+                # Dict to list
+                products = products.values()
+            else:
+                products = [products[productId]]
+            self._timings.count('products read from cache', len(products))
+        else:
+            if options.limit is not None and self.getCacheAge(options.assignee, filters) is None:
+                # with no cached items to bring up to date, fetch only the
+                # most recent items rather than filling the cache
+                products = self.iterRecentProducts(options.assignee, options.limit, productId, filters)
+            else:
+                # populate the cache from the API if possible (may not be
+                # possible, e.g. in the case of offline access), starting with
+                # this repository's product
+                products = self.iterRefreshedProducts(options.assignee, options.fullRefresh, productId, filters)
+            if productId is not None:
+                products = (product for product in products if str(product['id']) == productId)
+
+        if options.limit is not None:
+            products = self.limitItems(products, options.limit, options.limitScope == 'all')
+
+        if options.format != 'text':
+            self.printRecords(products, options.format)
+            return
+
+        # bring the history index up to date unless that would hold up the
+        # listing, in which case a process in the background does it
+        if not options.cached and self.updateCommitIndex(HISTORY_FOREGROUND_LIMIT) is None:
+            self.indexHistoryInBackground()
+
+        # the cache holds flat lists of items
+        def makeTree(product):
+            with self._timings.phase('tree'):
+                return dict(product, items=ItemsTree(product['items']).getTree())
+        products = (makeTree(product) for product in products)
 
         self.printList(products, options.assignee)
 
     def printList(self, products, assignee):
         """
-        Print a list of Sprint.ly items.
+        Print a list of Sprint.ly items, grouped by product and then status.
+        Each product is printed as soon as it is taken from the given
+        iterable.
         """
 
-        statusTree = {
-            'backlog': {},
-            'in-progress': {},
-            'completed': {},
-            'accepted': {},
-        }
-
         itemCount = 0
 
         userId = self.getUserId()
 
+        # items of this repository's product show the commits which reference
+        # them
+        commitIndex = self.getCommitIndex()
+        try:
+            repoProductId = self.getConfigValue('product')
+        except KeyError:
+            repoProductId = None
+
+        def makeHistoryString(number):
+            commits = history.get(number) if history is not None else None
+            if not commits:
+                return ''
+            count = len(commits)
+            return self.compile(' ${GREY}[%d commit%s, last %s]${NORMAL}') % (count, '' if count == 1 else 's', commits[0][0][:7])
+
         def makeAssigneeString(person):
-            if assignee == 'self' and person['id'] == userId or assignee == 'unassigned' and person is None:
+            if assignee == 'self' and person is not None and person.id == userId or assignee == 'unassigned' and person is None:
                 return ''
             if person is None:
-                colour = 'YELLOW'
-                name = 'unassigned'
-            else:
-                colour = 'CYAN'
-                name = '%s %s' % (person['first_name'], person['last_name'])
-            return ' ${GREY}(${%s}%s${GREY})${NORMAL}' % (colour, name)
+                return self.compile(' ${GREY}(${YELLOW}%s${GREY})${NORMAL}') % 'unassigned'
+            return self.compile(' ${GREY}(${CYAN}%s %s${GREY})${NORMAL}') % (person.first_name, person.last_name)
 
         for product in products:
-            for item in product['items']:
-                if not product['id'] in statusTree[item['status']]:
-                    statusTree[item['status']][product['id']] = []
-                    itemCount += 1
+            statusTree = {
+                'backlog': [],
+                'in-progress': [],
+                'completed': [],
+                'accepted': [],
+            }
 
-                statusTree[item['status']][product['id']].append(item)
+            for item, children in product['items']:
+                statusTree[item.status].append((item, children))
 
-        for key, status in iter(sorted(statusTree.items())):
-            if not len(status):
+            if not len(product['items']):
                 continue
+            itemCount += len(product['items'])
+            history = commitIndex.items if commitIndex is not None and str(product['id']) == repoProductId else None
 
-            self.cprint(ITEM_STATUSES[key], attr=[BRIGHT_MAGENTA, UNDERLINE])
+            with self._timings.phase('render'):
+                # each product goes to the terminal in a single write
+                lines = []
+                lines.append(self.render('${DEFAULT}Product: ${BOLD}${BRIGHT_BLUE}%s${NORMAL}${GREY} (https://sprint.ly/product/%d/)', args=(product['name'], product['id'])))
+                if product.get('stale') is not None:
+                    lines[-1] = self.render('${DEFAULT}Product: ${BOLD}${BRIGHT_BLUE}%s${NORMAL}${GREY} (https://sprint.ly/product/%d/) ${YELLOW}[cached %s ago]', args=(product['name'], product['id'], formatAge(time() - product['stale'])))
 
-            for product_id in status:
-                items = status[product_id]
-                name = items[0]['product']['name']
-                productId = str(items[0]['product']['id'])
-                printProduct = '${DEFAULT}Product: ${BOLD}${BRIGHT_BLUE}' + name + '${NORMAL}${GREY} (https://sprint.ly/product/' + productId + '/)'
-                self.cprint(printProduct)
+                for key, items in iter(sorted(statusTree.items())):
+                    if not len(items):
+                        continue
 
-                title_color = 'DEFAULT'
-                for item in items:
-                    attr = DIM if item['status'] in ('completed', 'accepted') else None
-                    color = ITEM_COLORS.get(item['type'])
-                    assigneeString = makeAssigneeString(item['assigned_to'])
+                    lines.append(self.render(ITEM_STATUSES[key], attr=[BRIGHT_MAGENTA, UNDERLINE]))
 
-                    printItem = '${%s} #%d${DEFAULT}:${%s} %s%s' % (color, item['number'], title_color, item['title'], assigneeString)
-                    self.cprint(printItem, attr=attr)
+                    for item, children in items:
+                        attr = DIM if item.status in ('completed', 'accepted') else None
+                        assigneeString = makeAssigneeString(item.assignee)
 
-                    if 'children' in item:
-                        for child in item['children']:
-                            attr = DIM if child['status'] in ('completed', 'accepted') else None
-                            childColor = ITEM_COLORS.get(child['type'])
-                            title = child['title']
-                            if child['status'] == 'in-progress':
-                                title = u'${GREEN}⧁ ${%s}%s' % (title_color, title)
-                            assigneeString = makeAssigneeString(child['assigned_to'])
+                        printItem = '${%s} #%%d${DEFAULT}:${DEFAULT} %%s%%s%%s' % ITEM_COLORS.get(item.type)
+                        lines.append(self.render(printItem, attr=attr, args=(item.number, item.title, assigneeString, makeHistoryString(item.number))))
 
-                            printChild = u'${%s}  #%d${DEFAULT}:${%s} %s%s' % (childColor, child['number'], title_color, title, assigneeString)
-                            self.cprint(printChild, attr=attr)
+                        for child in children:
+                            attr = DIM if child.status in ('completed', 'accepted') else None
+                            assigneeString = makeAssigneeString(child.assignee)
 
-            self.cprint('')
+                            if child.status == 'in-progress':
+                                printChild = u'${%s}  #%%d${DEFAULT}:${DEFAULT} ${GREEN}⧁ ${DEFAULT}%%s%%s%%s' % ITEM_COLORS.get(child.type)
+                            else:
+                                printChild = '${%s}  #%%d${DEFAULT}:${DEFAULT} %%s%%s%%s' % ITEM_COLORS.get(child.type)
+                            lines.append(self.render(printChild, attr=attr, args=(child.number, child.title, assigneeString, makeHistoryString(child.number))))
+
+                lines.append(self.render(''))
+                self._term.write('\r\n'.join(lines) + '\r\n')
 
         if itemCount == 0:
             self.cprint('No assigned items', attr=GREEN)
 
-    def populateProductsCache(self, assignee):
+    def printRecords(self, products, format):
         """
-        Populate the cache from the Sprint.ly API if possible.
+        Print one record per item, without any terminal formatting, as a JSON
+        array, newline-delimited JSON or tab-separated values with a header.
+        Output is flushed after each product so that it can be read as the
+        products are fetched.
         """
 
-        cache = self.getCache()
+        import json
+
+        def makeRecord(product, item):
+            person = item.assignee
+            return {
+                'product': product['id'],
+                'product_name': product['name'],
+                'number': item.number,
+                'type': item.type,
+                'status': item.status,
+                'title': item.title,
+                'assignee_id': person.id if person is not None else None,
+                'assignee': '%s %s' % (person.first_name, person.last_name) if person is not None else None,
+                'parent': item.parent.number if item.parent is not None else None,
+            }
+
+        def makeRow(record):
+            fields = (u'' if record[field] is None else unicode(record[field]) for field in RECORD_FIELDS)
+            return u'\t'.join(re.sub(r'[\t\r\n]', ' ', field) for field in fields)
+
+        separator = '['
+        if format == 'tsv':
+            self._output.write('\t'.join(RECORD_FIELDS) + '\n')
 
-        cache['products'] = {}
+        for product in products:
+            with self._timings.phase('render'):
+                lines = []
+                for item in product['items']:
+                    record = makeRecord(product, item)
+                    if format == 'tsv':
+                        lines.append(makeRow(record) + '\n')
+                    elif format == 'ndjson':
+                        lines.append(json.dumps(record, sort_keys=True) + '\n')
+                    else:
+                        lines.append(separator + json.dumps(record, sort_keys=True))
+                        separator = ',\n'
+                self._output.write(''.join(lines))
+                self._output.flush()
 
-        # get products from the API
-        products = self.sprintlyAPICall('products.json')
-        if not products:
-            raise SprintlyException('Unable to get product list.')
+        if format == 'json':
+            self._output.write('[]\n' if separator == '[' else '\n]\n')
 
-        # iterate over products
-        for product in products:
+    def populateProductsCache(self, assignee, fullRefresh=False, filters=None):
+        """
+        Populate the cache from the Sprint.ly API if possible.
+        """
 
-            productName = product['name']
-            productId = str(product['id'])
-            productNameWithUrl = '\'' + productName + '\' (https://sprint.ly/product/' + productId + '/)'
-
-            # get all items assigned to current user
-            items = []
-            offset = 0
-            limit = 100
-            if assignee == 'anyone':
-                assigneeString = ''
-            elif assignee == 'self':
-                assigneeString = 'assigned_to=%s&' % self.getUserId()
-            elif assignee == 'unassigned':
-                assigneeString = 'assigned_to=&'
-            else:
-                raise ValueError
-            while True:
-                itemsPartial = self.sprintlyAPICall('products/' + productId + '/items.json?' + assigneeString + 'children=1&limit=' + str(limit) + '&offset=' + str(offset))
+        for product in self.iterRefreshedProducts(assignee, fullRefresh, filters=filters):
+            pass
 
-                # if we get nothing, an empty list, an error, quit
-                if not itemsPartial or len(itemsPartial) == 0 or 'code' in items:
-                    break
-                # otherwise, add on these items and increase the offset
-                else:
-                    items = items + itemsPartial
-                    offset = offset + limit
+    def getFilters(self, options):
+        """
+        Get the status and type filters given in the options, as a map of
+        the API's query parameter to the sorted values it allows.
+        """
 
-                # if we got less than a full response, no need to check again
-                if len(itemsPartial) < limit:
-                    break
+        filters = {}
+        if options.statuses:
+            filters['status'] = sorted(set(options.statuses))
+        if options.types:
+            filters['type'] = sorted(set(options.types))
+        return filters
 
-            # if anything went wrong, print an error message
-            if 'code' in items:
-                # include message if applicable
-                message = ''
-                if 'message' in items:
-                    message = ': %s' % items['message']
-                self.cprint('Warning: unable to get items for %s%s' % (productNameWithUrl, message), attr=YELLOW)
-                continue
-            # a 'parent' is any item without a parent key
-            # a 'child' is any item with a parent key
-            # sort so that all parents appear first and all children appear after ordered by their number
-            items.sort(key=lambda item: item['number'] if 'parent' in item else sys.maxint, reverse=True)
+    def iterRefreshedProducts(self, assignee, fullRefresh=False, first=None, filters=None):
+        """
+        Refresh the cached products and items for the given assignee and
+        filters, generating each product as soon as it and those before it
+        have been refreshed, the one with ID first, if any, first. Products
+        not refreshed within sprintly.deadline seconds come from the cache,
+        marked as stale.
+        """
+
+        snapshot = self.getSnapshot(assignee, filters)
+        if time() - snapshot.get('full_at', 0) > self.getIntConfigValue('fullrefresh', DEFAULT_FULL_REFRESH):
+            fullRefresh = True
 
-            # turn flat list into tree
-            itemsTree = []
-            parentMapping = {} # allow parents to be looked up by number
+        for product in self._iterWithDeadline(self._iterRefreshedProducts(snapshot, fullRefresh, first, assignee, filters)):
+            yield product
 
-            for item in items:
-                number = str(item['number'])
+    def _iterWithDeadline(self, products):
+        """
+        Generate the given products, with the API calls made for them bound
+        to finish within sprintly.deadline seconds, and close the connections
+        to the API once they are done.
+        """
+
+        client = self.getAPIClient()
+        client.deadline = time() + self.getIntConfigValue('deadline', DEFAULT_DEADLINE)
+        try:
+            for product in products:
+                yield product
+        finally:
+            client.deadline = None
+            client.close()
 
-                # if item is not a child
-                if 'parent' not in item:
-                    itemsTree.append(item)
-                    parentMapping[number] = item
+    def _iterRefreshedProducts(self, snapshot, fullRefresh, first, assignee, filters):
+        """
+        Refresh the products of the given snapshot as iterRefreshedProducts
+        describes, once the deadline is set.
+        """
 
-                # if item is a child...
+        storedProducts = snapshot['products']
+        try:
+            products = self._getProducts(first)
+        except SprintlyException as e:
+            if 'refreshed_at' not in snapshot:
+                raise
+            self.cprint('Warning: %s Showing the items cached %s ago.' % (e.value, formatAge(time() - snapshot['refreshed_at'])), attr=YELLOW)
+            productIds = sorted(storedProducts.keys(), key=lambda productId: productId != first)
+            for productId in productIds:
+                cached = storedProducts.get(productId)
+                if cached is not None:
+                    self._timings.count('products stale')
+                    yield dict(cached, stale=snapshot['refreshed_at'])
+            return
+
+        queryString = self._getQueryString(assignee, filters)
+        itemFilter = self._getItemFilter(assignee, filters)
+
+        # read what we have of each product before any work is shared out,
+        # and how many items each had, to plan the pages of those fetched in
+        # full
+        if fullRefresh:
+            stored = [None] * len(products)
+        else:
+            stored = [storedProducts.get(str(product['id'])) for product in products]
+        sizes = [len(storedProducts.index.get(str(product['id']), ())) or None for product in products]
+
+        # forget products which no longer exist
+        productIds = set(str(product['id']) for product in products)
+        for productId in storedProducts.keys():
+            if productId not in productIds:
+                del storedProducts[productId]
+
+        from itertools import izip
+        from multiprocessing.pool import ThreadPool
+
+        # fetch the items of each product in parallel; imap gives results in
+        # the same order as the product list regardless of completion order.
+        # The pages of products fetched in full are shared out separately, so
+        # that the products' threads can wait for them
+        concurrency = max(1, self.getIntConfigValue('concurrency', DEFAULT_CONCURRENCY))
+        pool = ThreadPool(min(concurrency, len(products)))
+        if any(record is None and size is not None for record, size in zip(stored, sizes)):
+            self._pagePool = ThreadPool(concurrency)
+        try:
+            results = pool.imap(lambda (product, record, size): self._refreshProduct(product, record, queryString, itemFilter, size), zip(products, stored, sizes))
+
+            # iterate over products
+            stale = False
+            warned = False
+            for product, storedRecord, (record, error) in izip(products, stored, results):
+
+                productId = str(product['id'])
+
+                # if Sprint.ly didn't answer, keep what we had before, marked
+                # as stale, and don't let the snapshot pass for complete
+                if error is NO_RESPONSE or error is not None and error.get('code') in RETRY_STATUSES:
+                    stale = True
+                    if productId in storedProducts and 'refreshed_at' in snapshot:
+                        self._timings.count('products stale')
+                        if not warned:
+                            self.cprint('Warning: Sprint.ly did not answer for every product; showing items cached %s ago.' % formatAge(time() - snapshot['refreshed_at']), attr=YELLOW)
+                            warned = True
+                        yield dict(storedProducts[productId], stale=snapshot['refreshed_at'])
+                        continue
+
+                # if anything went wrong, print an error message and keep what
+                # we had before, if anything
+                if error is not None:
+                    self._timings.count('products failed')
+                    self._warnProductError(product, error)
+                    if productId in storedProducts:
+                        yield storedProducts[productId]
+                    continue
+
+                # only store products which have changed
+                if record is storedRecord:
+                    self._timings.count('products unchanged')
                 else:
-                    parent = item['parent']  # get reference to parent
-                    del item['parent']  # remove parent from child
-                    parentNumber = str(parent['number'])
+                    self._timings.count('products fetched in full' if storedRecord is None else 'products updated')
+                    storedProducts[productId] = record
+                yield record
+        finally:
+            pool.close()
+            pool.join()
+            if self._pagePool is not None:
+                self._pagePool.close()
+                self._pagePool.join()
+                self._pagePool = None
+
+        if stale:
+            return
+        snapshot['refreshed_at'] = time()
+        if fullRefresh:
+            snapshot['full_at'] = snapshot['refreshed_at']
+        self._cacheChanged = True
+
+    def iterRecentProducts(self, assignee, limit, productId=None, filters=None):
+        """
+        Generate each product, or only the one with ID productId if given,
+        with only its limit most recently modified items for the given
+        assignee and filters, paging through each product's items only until
+        enough have been fetched, within sprintly.deadline seconds. The cache
+        is left alone since the items are incomplete.
+        """
 
-                    # if we have the parent, nest under parent
-                    if parentNumber in parentMapping:
+        for product in self._iterWithDeadline(self._iterRecentProducts(assignee, limit, productId, filters)):
+            yield product
 
-                        # we sorted items above to ensure all parents will be in map before any child is encountered
-                        parent = parentMapping[parentNumber]
-                        if 'children' not in parent:
-                            parent['children'] = []
-                        parent['children'].append(item)
+    def _iterRecentProducts(self, assignee, limit, productId, filters):
+        """
+        Generate the products as iterRecentProducts describes, once the
+        deadline is set.
+        """
 
-                    # if we don't have the parent, add placeholder parent to preserve tree structure
-                    else:
-                        parent['children'] = [item]
-                        parentMapping[parentNumber] = parent
-                        itemsTree.append(parent)
+        products = self._getProducts()
+        if productId is not None:
+            products = [product for product in products if str(product['id']) == productId]
+        queryString = self._getQueryString(assignee, filters)
 
-            # sort items by (status, then first child, if it exists, else number)
-            itemsTree.sort(key=lambda item: item['children'][0]['number'] if 'children' in item else item['number'], reverse=True)
-            product['items'] = itemsTree
-            cache['products'][productId] = product
+        from itertools import izip
+        from multiprocessing.pool import ThreadPool
 
-    def writeCache(self):
+        pool = ThreadPool(max(1, min(self.getIntConfigValue('concurrency', DEFAULT_CONCURRENCY), len(products))))
+        try:
+            results = pool.imap(lambda product: self._fetchRecentItems(str(product['id']), queryString, limit), products)
+            for product, items in izip(products, results):
+                if isinstance(items, dict):
+                    self._timings.count('products failed')
+                    self._warnProductError(product, items)
+                    continue
+                self._timings.count('products fetched in part')
+                yield dict(product, items=items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def limitItems(self, products, limit, overall=False):
         """
-        Write the current cache object to disk
+        Generate the given products with only the limit most recently
+        modified items of each, or of all of them together if overall is set,
+        in which case nothing is generated until every product has been read.
         """
 
-        cache = self.getCache()
-        cache['updated_at'] = time()
-        serialized_cache = json.dumps(cache)
+        import heapq
 
-        cache_file = open(self._sprintlyCachePath, 'w')
-        cache_file.write(serialized_cache)
-        cache_file.close()
+        recent = lambda item: item.lastModified
+        if not overall:
+            for product in products:
+                yield dict(product, items=heapq.nlargest(limit, product['items'], key=recent))
+            return
 
-    def _readCache(self):
+        products = list(products)
+        kept = set(heapq.nlargest(limit, (item for product in products for item in product['items']), key=recent))
+        for product in products:
+            yield dict(product, items=[item for item in product['items'] if item in kept])
+
+    def _getProducts(self, first=None):
         """
-        Read from the cache from disk and return it
+        Get the list of products from the API, the one with ID first, if any,
+        first.
         """
 
-        try:
-            os.mkdir(self._sprintlyDirectoryPath, 0700)
-        except OSError:
-            # Already exists
-            pass
-        except IOError:
-            raise SprintlyException('Unable to create folder at %s' % self._sprintlyDirectoryPath)
+        products = self.sprintlyAPICall('products.json')
+        if products is False or isinstance(products, dict) and products.get('code') in RETRY_STATUSES:
+            raise SprintlyException('Unable to reach Sprint.ly.')
+        if not products or not isinstance(products, list):
+            raise SprintlyException('Unable to get product list.')
+        products.sort(key=lambda product: str(product['id']) != first)
+        return products
 
-        try:
-            cache_file = open(self._sprintlyCachePath, 'r')
-            serialized_cache = cache_file.readline()
-            cache_file.close()
-            try:
-                cache = json.loads(serialized_cache)
-            except ValueError:
-                # Bad JSON; ignore and replace
-                cache = {}
-        except IOError:
-            # File doesn't exist yet
-            cache = {}
+    def _getQueryString(self, assignee, filters=None):
+        """
+        Get the query parameters selecting a product's items for the given
+        assignee and filters, each followed by an ampersand.
+        """
 
-        return cache
+        if assignee == 'anyone':
+            queryString = ''
+        elif assignee == 'self':
+            queryString = 'assigned_to=%s&' % self.getUserId()
+        elif assignee == 'unassigned':
+            queryString = 'assigned_to=&'
+        else:
+            raise ValueError
+        for name, values in sorted((filters or {}).items()):
+            queryString += '%s=%s&' % (name, ','.join(values))
+        return queryString
 
-    def getCache(self):
+    def _warnProductError(self, product, error):
         """
-        Get the cache from memory or from file
+        Warn that the items of a product could not be fetched, with the API's
+        error message if there is one.
         """
 
-        if self._cache is None:
-            self._cache = self._readCache()
-        return self._cache
+        # include message if applicable
+        message = ''
+        if 'message' in error:
+            message = ': %s' % error['message']
+        productNameWithUrl = '\'' + product['name'] + '\' (https://sprint.ly/product/' + str(product['id']) + '/)'
+        self.cprint('Warning: unable to get items for %s%s' % (productNameWithUrl, message), attr=YELLOW)
 
-    def sprintlyAPICall(self, url):
+    def getSnapshot(self, assignee, filters=None):
         """
-        Wraps up a call to the Sprint.ly api. Returns a map representing the
-        JSON response or false if the call could not be completed.
+        Get the cached snapshot of the products and items for this user, the
+        given assignee and filters, starting an empty one if there is none.
+        Each snapshot records when it was last refreshed and used, the latter
+        only to within USED_AT_INTERVAL unless the cache changes anyway.
+        """
+
+        snapshots = self.getCache().setdefault('snapshots', {})
+        key = self._getSnapshotKey(assignee, filters)
+        if key not in snapshots:
+            snapshots[key] = {'user': self.getConfigValue('user'), 'assignee': assignee, 'filters': filters or {}, 'products': []}
+        snapshot = self._loadSnapshot(key)
+        if time() - snapshot.get('used_at', 0) > USED_AT_INTERVAL:
+            self._cacheChanged = True
+        snapshot['used_at'] = time()
+        return snapshot
+
+    def _loadSnapshot(self, key):
+        """
+        Get the cached snapshot with the given key, with its products ready
+        to be read as they are used.
         """
 
-        url = 'https://sprint.ly/api/%s' % url
+        snapshot = self.getCache()['snapshots'][key]
+        if not isinstance(snapshot['products'], ProductStore):
+            snapshot['products'] = ProductStore(self._getSnapshotPath(key), snapshot['products'], snapshot.pop('index', {}))
+        return snapshot
+
+    def getCachedItems(self):
+        """
+        Get the cached items of this repository's product from all of this
+        user's snapshots, the most recently modified copy of each, or nothing
+        if the repository has no product.
+        """
 
         try:
-            userData = 'Basic ' + (self.getConfigValue('user') + ':' + self.getConfigValue('key')).encode('base64').replace("\n",'')
-            req = urllib2.Request(url)
-            req.add_header('Accept', 'application/json')
-            req.add_header('Authorization', userData)
-            res = urllib2.urlopen(req)
-            response = res.read()
-            return json.loads(response)
-        except urllib2.HTTPError, error:
-            response = error.read()
-            return json.loads(response)
-        except Exception:
-            return False
+            productId = self.getConfigValue('product')
+        except KeyError:
+            return []
 
-    def installHook(self):
+        items = {}
+        user = self.getConfigValue('user')
+        for key, snapshot in self.getCache().get('snapshots', {}).items():
+            if snapshot['user'] != user:
+                continue
+            product = self._loadSnapshot(key)['products'].get(productId)
+            if product is None:
+                continue
+            for item in product['items']:
+                if item.number not in items or item.lastModified > items[item.number].lastModified:
+                    items[item.number] = item
+        return items.values()
+
+    def forgetChangedCache(self):
         """
-        A symlink will be created from <git repo root>/.git/hooks/commit-msg
-        to the Sprintly commit message hook.
-        If a commit message hook already exists it will be moved.
+        Forget the cache held in memory if another process has written it
+        since it was read, so that it is read again when next used.
         """
 
-        # Ensure we are in a git repository
-        if self._repo is None:
-            raise SprintlyException('This command can only be run from a git repository.')
+        if self._cache is not None and self._getManifestStamp() != self._cacheStamp:
+            self._cache = None
 
-        hooks_directory = os.path.join(self._repo.controldir(), 'hooks')
+    def getCacheAge(self, assignee, filters=None):
+        """
+        Get the number of seconds since the snapshot for the given assignee
+        and filters was refreshed, or None if there is no such snapshot.
+        """
 
-        # create a symlink to the commit-msg file
-        destination = os.path.join(hooks_directory, HOOK_NAME)
+        snapshot = self.getCache().get('snapshots', {}).get(self._getSnapshotKey(assignee, filters), {})
+        if 'refreshed_at' not in snapshot:
+            return None
+        return time() - snapshot['refreshed_at']
 
-        # If the destination is not our hook, move it
-        if os.path.exists(destination):
-            if os.path.realpath(destination) == os.path.realpath(HOOK_PATH):
-                self.cprint('Hook is already installed.', attr=GREEN)
-                return
-            originalDestination = os.path.join(hooks_directory, ORIGINAL_HOOK_NAME)
-            if os.path.exists(originalDestination):
-                print HOOK_PATH
-                self.cprint('A commit hook (not sprintly) already exists at %s, as does where we would normally move that file, %s. This must be resolved manually.' % (destination, originalDestination), attr=RED)
-                return
-            shutil.move(destination, originalDestination)
-            self.cprint('Existing hook moved to %s' % originalDestination, attr=YELLOW)
+    def _getSnapshotKey(self, assignee, filters=None):
+        key = '%s %s' % (self.getConfigValue('user'), assignee)
+        for name, values in sorted((filters or {}).items()):
+            key += ' %s=%s' % (name, ','.join(values))
+        return key
 
-        self.cprint('Creating symlink...')
+    def _getSnapshotPath(self, key):
+        import hashlib
+        return os.path.join(self._sprintlyCachePath, 'snapshots', hashlib.md5(key).hexdigest())
 
-        try:
-            os.symlink(HOOK_PATH, destination)
-        except Exception:
-            raise SprintlyException('Unable to create symlink.')
+    def refreshInBackground(self, assignee, cwd=None):
+        """
+        Start a detached process which refreshes the cache with the items for
+        the given assignee, ready for the next run, and the history index of
+        the repository it runs in.
+        """
 
-        self.cprint('Hook was installed at %s' % destination, attr=GREEN)
+        self._runInBackground(['--refresh', '--' + assignee], cwd)
 
-        # check to see if the email associated with git matches the Sprint.ly email
-        # if not, Sprint.ly won't be able to create comments
-        try:
-            process = subprocess.Popen(['git', 'config', 'user.email'], stdout=subprocess.PIPE)
-            gitEmail = process.stdout.read().strip()
-            if gitEmail != self.getConfigValue('user'):
-                self.cprint('WARNING: Your git email (' + gitEmail + ') does not match your Sprint.ly username (' + self.getConfigValue('user') + ')', attr=YELLOW)
-                self.cprint('WARNING: Don\'t worry - there is an easy fix. Simply run one of the following:', attr=YELLOW)
-                self.cprint('\t\'git config --global user.email ' + self.getConfigValue('user') + '\' (all repos)')
-                self.cprint('\t\'git config user.email ' + self.getConfigValue('user') + '\' (this repo only)')
-        except Exception:
-            self.cprint('Unable to verify that \'git config user.email\' matches your Sprint.ly account email.', attr=RED)
+    def indexHistoryInBackground(self):
+        """
+        Start a detached process which brings the history index of this
+        repository up to date, without refreshing the cache.
+        """
 
-    def uninstallHook(self):
+        self._runInBackground(['--index-history'])
+
+    def startAgent(self):
         """
-        Remove the symlink we created, as long as it points to our hook. If an
-        old hook was previously moved by us, move it back.
+        Start the agent in a detached process, unless it is already running.
         """
 
-        # Ensure we are in a git repository
-        if self._repo is None:
-            raise SprintlyException('This command can only be run from a git repository.')
+        if not SprintlyAgent.isRunning():
+            self._runInBackground(['--agent'], os.path.expanduser('~'))
 
-        hooks_directory = os.path.join(self._repo.controldir(), 'hooks')
+    def _runInBackground(self, args, cwd=None):
+        """
+        Run the sprintly tool with the given arguments in a detached process.
+        """
 
-        # get path to commit-msg file
-        destination = os.path.join(hooks_directory, HOOK_NAME)
+        import subprocess
 
-        # if the destination is a file, error; if it's a symlink, delete it
-        try:
-            if not os.path.exists(destination):
-                self.cprint('There is no commit hook installed.', attr=YELLOW)
-                return
-            elif not os.path.isfile(destination):
-                raise SprintlyException('Commit hook is not a file.')
-            elif os.path.realpath(destination) != os.path.realpath(HOOK_PATH):
-                raise SprintlyException('The commit-msg hook was not installed by this tool. Please remove it manually.')
-            else:
-                os.unlink(destination)
-        except SprintlyException as e:
-            raise e
+        # make sure this copy of the module is the one imported
+        path = [os.path.dirname(os.path.abspath(__file__))]
+        if 'PYTHONPATH' in os.environ:
+            path.append(os.environ['PYTHONPATH'])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
 
-        self.cprint('Hook has been uninstalled.', attr=GREEN)
+        devnull = open(os.devnull, 'r+')
+        subprocess.Popen([sys.executable, '-c', 'import sprintly; sprintly.main()'] + args, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid, env=env, cwd=cwd)
+        devnull.close()
 
-        # If it exists, move the original hook back to commit-msg
-        originalDestination = os.path.join(hooks_directory, ORIGINAL_HOOK_NAME)
-        if os.path.exists(originalDestination):
-            shutil.move(originalDestination, destination)
-            self.cprint('Moved original commit hook back to %s' % destination, attr=YELLOW)
+    def _refreshProduct(self, product, stored, queryString, itemFilter, size=None):
+        """
+        Fetch the items of a product: all of them, or, given the product's
+        cached record, those changed since it was stored. The number of items
+        it had last time, if known, is the size. Runs in a worker thread so
+        must not print or touch the cache. Returns the new record for the
+        product and the API's error response if something went wrong.
+        """
 
-    def cprint(self, str, attr=None, trim=True):
-        self._term.write(self.render(str, attr, trim) + '\r\n')
+        productId = str(product['id'])
+
+        if stored is None or stored.get('cursor') is None:
+            # see where the changes to the product stand before fetching its
+            # items, so that the next refresh looks back no further than the
+            # last change by anyone, and catches items which joined the query
+            # while the pages were being fetched
+            result = self._probeChanges(productId)
+            if isinstance(result, dict):
+                return None, result
+            cursor, etag, lastModified = result
+            items = self._fetchProductItems(productId, queryString, size)
+            if isinstance(items, dict):
+                return None, items
+            return dict(product, items=items, etag=etag, lastModified=lastModified, cursor=cursor), None
+
+        result = self._fetchChangedItems(productId, stored)
+        if isinstance(result, dict):
+            return None, result
+        changed, etag, lastModified = result
+
+        record = dict(product, items=stored['items'], etag=etag, lastModified=lastModified, cursor=stored['cursor'])
+        if not changed and record == stored:
+            return stored, None
+        if changed:
+            # apply the changes oldest first, dropping items which no longer
+            # match the assignee and filters
+            items = dict((item.number, item) for item in stored['items'])
+            for item in reversed(changed):
+                if itemFilter(item):
+                    items[item.number] = item
+                else:
+                    items.pop(item.number, None)
+            record['items'] = items.values()
+            record['cursor'] = max([stored['cursor']] + [item.lastModified for item in changed])
+        return record, None
 
-    def render(self, str, attr=None, trim=True):
-        if self._has_color:
-            if attr:
-                if isinstance(attr, list):
-                    attr = ''.join(attr)
+    def _fetchProductItems(self, productId, queryString, size=None):
+        """
+        Get all items of a product matching the query string, paging through
+        them oldest first, an order edits don't change. Given the number of
+        items the product had last time, the pages it should take are
+        requested at once, in parallel, and any further pages after them.
+        Returns the list of items, or the API's error response.
+        """
+
+        url = 'products/' + productId + '/items.json?' + queryString + 'children=1&order_by=oldest'
+
+        # plan the pages as offsets and limits
+        pages = [(0, PAGE_SIZE)]
+        if size is not None:
+            target = size + max(PAGE_MARGIN, size // 10)
+            if target < PAGE_SIZE:
+                pages = [(0, target + 1)]
             else:
-                attr = ''
+                step = PAGE_SIZE - PAGE_OVERLAP
+                count = 1 + (target + 1 - PAGE_SIZE + step - 1) // step
+                pages = [(i * step, PAGE_SIZE) for i in range(count)]
+
+        for i in range(PAGE_ATTEMPTS):
+            items = self._fetchPages(url, pages)
+            if items is not None:
+                return items
+            self._timings.count('products paged again')
+        return {'message': 'items kept moving while being fetched'}
+
+    def _fetchPages(self, url, pages):
+        """
+        Get the items of a paged API call, requesting the given pages (as
+        offsets and limits) in parallel and then further pages one at a time
+        until one is short. Consecutive pages share PAGE_OVERLAP items, so
+        that items removed between requests shift no others past a page
+        unnoticed. Returns the list of items, the API's error response, or
+        None if a page doesn't start among the items of the one before.
+        """
 
-            seq = re.sub(r'\$\$|\${\w+}', self._render_sub, str)
-            if trim:
-                seq = self._trim(seq)
+        def fetch((offset, limit)):
+            return self.sprintlyAPICall(url + '&limit=' + str(limit) + '&offset=' + str(offset), Item.fromAPI)
 
-            return attr + seq + RESET
+        if len(pages) > 1 and self._pagePool is not None:
+            results = self._pagePool.map(fetch, pages)
         else:
-            seq = re.sub(r'\$\$|\${\w+}', '', str)
-            if trim and len(seq) > self._cols:
-                return seq[0:self._cols - 1] + u'\u2026'
-            return seq
-
-    def _render_sub(self, match):
-        s = match.group()
-        if s == '$$': return s
-        else: return ATTRS.get(s[2:-1], '')
+            results = [fetch(page) for page in pages]
 
-    def _trim(self, raw):
-        # TODO: >>> This could probably be much simpler if I was smarter
-        seq = ''
-        str_len = 0
-        i = 0
-        matchiter = re.finditer(r'(\x1b.*?m)', raw.strip())
-        for match in matchiter:
-            chunk = raw[i:match.start()]
-            i = match.end()
-            if str_len + len(chunk) > self._cols:
-                chunk = chunk[0:self._cols - str_len - 1] + u'\u2026'
-            str_len = str_len + len(chunk)
-            seq = seq + chunk + match.group()
+        items = []
+        positions = {}
+        previous = None
+        while True:
+            for (offset, limit), page in zip(pages, results):
+                # if we get an error, or no answer, pass it on
+                if isinstance(page, dict):
+                    return page
+                if page is False:
+                    return NO_RESPONSE
+                page = page or []
+
+                if previous is not None and (not page or page[0].number not in previous):
+                    return None
+                for item in page:
+                    position = positions.get(item.number)
+                    if position is None:
+                        positions[item.number] = len(items)
+                        items.append(item)
+                    elif item.lastModified > items[position].lastModified:
+                        items[position] = item
+
+                # if we got less than a full page, there are no more
+                if len(page) < limit:
+                    return items
+                previous = set(item.number for item in page)
+
+            offset, limit = pages[-1]
+            pages = [(offset + limit - PAGE_OVERLAP, PAGE_SIZE)]
+            results = [fetch(pages[0])]
+
+    def _fetchRecentItems(self, productId, queryString, limit):
+        """
+        Get up to limit of the most recently modified items of a product
+        matching the query string, requesting no more pages than that needs.
+        Returns the list of items, or the API's error response.
+        """
 
-            if (str_len >= self._cols):
+        items = []
+        for itemsPartial in self._iterItemPages('products/' + productId + '/items.json?' + queryString + 'children=1&order_by=recent', min(limit, PAGE_SIZE)):
+            # if we get an error, pass it on
+            if isinstance(itemsPartial, dict):
+                return itemsPartial
+            items.extend(itemsPartial[:limit - len(items)])
+            if len(items) >= limit:
                 break
+        return items
 
-        if str_len < self._cols:
-            chunk = raw[i:]
-            if str_len + len(chunk) > self._cols:
-                chunk = chunk[0:self._cols - str_len - 1] + u'\u2026'
-            seq = seq + chunk
+    def _iterItemPages(self, url, limit=PAGE_SIZE):
+        """
+        Generate the pages of items of a paged API call, each a list of Items,
+        until a page is short. An error response, if there is one, is the
+        last thing generated.
+        """
 
-        return seq
+        offset = 0
+        while True:
+            itemsPartial = self.sprintlyAPICall(url + '&limit=' + str(limit) + '&offset=' + str(offset), Item.fromAPI)
 
-    def elipsify(self, seq):
-        return seq[0:-1].strip(string.punctuation) + u'\u2026'
+            # if we get an error, or no answer, pass it on
+            if isinstance(itemsPartial, dict):
+                yield itemsPartial
+                return
+            if itemsPartial is False:
+                yield NO_RESPONSE
+                return
+            # if we get nothing or an empty list, quit
+            if not itemsPartial or len(itemsPartial) == 0:
+                return
 
+            yield itemsPartial
 
-class SprintlyCommitHook:
-    def __init__(self):
-        self._sprintlyTool = None
+            # if we got less than a full response, no need to check again
+            if len(itemsPartial) < limit:
+                return
+            offset = offset + limit
 
-    def getSprintlyTool(self):
-        if self._sprintlyTool is not None:
-            return self._sprintlyTool
-        self._sprintlyTool = SprintlyTool()
-        return self._sprintlyTool
+    def _probeChanges(self, productId):
+        """
+        Get the modification time of the most recently modified item of a
+        product, whoever it is assigned to, and the ETag and Last-Modified
+        headers of the first page _fetchChangedItems requests. Returns them,
+        or the API's error response.
+        """
 
-    def run(self):
+        status, responseHeaders, items = self.getAPIClient().fetch('products/' + productId + '/items.json?children=1&order_by=recent&limit=' + str(DELTA_PROBE_LIMIT) + '&offset=0', None, Item.fromAPI)
+        if status is None:
+            return NO_RESPONSE
+        if isinstance(items, dict):
+            return items
+        if not isinstance(items, list):
+            return {'code': status}
+        return max([item.lastModified for item in items] or [None]), responseHeaders.get('etag'), responseHeaders.get('last-modified')
+
+    def _fetchChangedItems(self, productId, stored):
         """
-        Run the hook
+        Get the items of a product, whoever they are assigned to, which were
+        modified since the stored record's cursor, most recent first. The
+        first page is small and is requested conditionally on the validators
+        of the last one, so that an unchanged product costs one cheap request.
+        Returns the changed items (None if the first page was not modified)
+        and the first page's ETag and Last-Modified headers, or the API's
+        error response.
+        """
+
+        items = []
+        etag = stored.get('etag')
+        lastModified = stored.get('lastModified')
+        offset = 0
+        limit = DELTA_PROBE_LIMIT
+        while True:
+            headers = {}
+            if offset == 0:
+                if etag:
+                    headers['If-None-Match'] = etag
+                if lastModified:
+                    headers['If-Modified-Since'] = lastModified
+            status, responseHeaders, itemsPartial = self.getAPIClient().fetch('products/' + productId + '/items.json?children=1&order_by=recent&limit=' + str(limit) + '&offset=' + str(offset), headers, Item.fromAPI)
+
+            if status == 304:
+                return None, etag, lastModified
+            if status is None:
+                return NO_RESPONSE
+            if isinstance(itemsPartial, dict):
+                return itemsPartial
+            if not isinstance(itemsPartial, list):
+                return {'code': status}
+            if offset == 0:
+                etag = responseHeaders.get('etag')
+                lastModified = responseHeaders.get('last-modified')
+
+            # stop at the first item older than the cursor
+            for item in itemsPartial:
+                if item.lastModified is not None and item.lastModified < stored['cursor']:
+                    return items, etag, lastModified
+                items.append(item)
+
+            if len(itemsPartial) < limit:
+                return items, etag, lastModified
+            offset = offset + limit
+            limit = PAGE_SIZE
+
+    def _getItemFilter(self, assignee, filters=None):
+        """
+        Get a function telling whether an item belongs in the list of items
+        for the given assignee and filters.
+        """
+
+        if assignee == 'anyone':
+            assigneeFilter = lambda item: True
+        elif assignee == 'self':
+            userId = self.getUserId()
+            assigneeFilter = lambda item: item.assignee is not None and item.assignee.id == userId
+        elif assignee == 'unassigned':
+            assigneeFilter = lambda item: item.assignee is None
+        else:
+            raise ValueError
+
+        if not filters:
+            return assigneeFilter
+        statuses = filters.get('status')
+        types = filters.get('type')
+        return lambda item: assigneeFilter(item) and (statuses is None or item.status in statuses) and (types is None or item.type in types)
+
+    def getIntConfigValue(self, key, default):
+        """
+        Get an integer from the sprintly section of the git configuration, or
+        the given default if it is not set.
         """
 
         try:
-            if len(sys.argv) > 1:
-                self.process(commit_msg_path=sys.argv[1])
+            return int(self.getConfigValue(key))
+        except KeyError:
+            return default
+        except ValueError:
+            raise SprintlyException('sprintly.%s must be an integer.' % key)
+
+    def writeCache(self):
+        """
+        Write the current cache object to disk, if it has changed since it was
+        read, merging in what other processes have written since. Only the
+        sprintly.snapshots most recently used snapshots are kept.
+        """
+
+        import json
+        import shutil
+
+        cache = self.getCache()
+        snapshots = cache.get('snapshots', {})
+        if not self._cacheChanged and not any(isinstance(snapshot['products'], ProductStore) and snapshot['products'].hasChanges() for snapshot in snapshots.values()):
+            self._timings.count('cache writes skipped')
+        else:
+            lock = self._lockCache()
+            try:
+                if self._getManifestStamp() != self._cacheStamp:
+                    self._mergeCache()
+                cache['version'] = CACHE_VERSION
+                cache['updated_at'] = time()
+
+                # forget the least recently used snapshots
+                keep = max(1, self.getIntConfigValue('snapshots', DEFAULT_SNAPSHOTS))
+                for key in sorted(snapshots, key=lambda key: snapshots[key].get('used_at', 0), reverse=True)[keep:]:
+                    del snapshots[key]
+                    shutil.rmtree(self._getSnapshotPath(key), True)
+
+                manifest = dict(cache, snapshots={})
+                for key, snapshot in snapshots.items():
+                    products = snapshot['products']
+                    if isinstance(products, ProductStore):
+                        products.save()
+                        snapshot = dict(snapshot, products=products.keys(), index=products.index)
+                    manifest['snapshots'][key] = snapshot
+
+                writeFileAtomically(self._getManifestPath(), json.dumps(manifest))
+                self._cacheStamp = self._getManifestStamp()
+                self._cacheChanged = False
+            finally:
+                # closing the file releases the lock
+                os.close(lock)
+
+        if self._repo is not None:
+            self._writeItemNumbers(snapshots.values())
+
+    def _lockCache(self):
+        """
+        Wait for and take the lock on writing the cache. Returns the lock
+        file's descriptor; closing it releases the lock.
+        """
+
+        import fcntl
+
+        lock = os.open(os.path.join(self._sprintlyCachePath, 'lock'), os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _mergeCache(self):
+        """
+        Merge the cache written to disk by another process since this one read
+        it into this one's: of each snapshot the more recently refreshed copy
+        is kept, as last used by either, and user IDs are kept from both.
+        """
+
+        self._timings.count('cache writes merged')
+        theirs, _ = self._readManifest()
+        if theirs.get('version') != CACHE_VERSION:
+            return
+
+        cache = self.getCache()
+        cache['userId'] = dict(theirs.get('userId', {}), **cache.get('userId', {}))
+        snapshots = cache.setdefault('snapshots', {})
+        for key, snapshot in theirs.get('snapshots', {}).items():
+            ours = snapshots.get(key)
+            if ours is None:
+                snapshots[key] = snapshot
+            elif snapshot.get('refreshed_at', 0) > ours.get('refreshed_at', 0):
+                snapshot['used_at'] = max(snapshot.get('used_at', 0), ours.get('used_at', 0))
+                snapshots[key] = snapshot
             else:
-                # Should never happen, but just in case...
-                raise Exception('Commit message was not received.')
-        except KeyboardInterrupt:
-            die('Program interrupted. Commit aborted.')
-        except Exception as e:
-            die('Error occurred. Commit aborted.')
+                ours['used_at'] = max(snapshot.get('used_at', 0), ours.get('used_at', 0))
+
+    def getCommitIndex(self):
+        """
+        Get the index of the item numbers referenced by this repository's
+        commits, as last brought up to date, or None outside a repository.
+        """
+
+        if self._commitIndex is None and self._repo is not None:
+            with self._timings.phase('history'):
+                self._commitIndex = CommitIndex(os.path.join(getRepoCachePath(self._sprintlyCachePath, self._repo.controldir()), 'commits'), self._repo)
+        return self._commitIndex
+
+    def updateCommitIndex(self, limit=None):
+        """
+        Read the commits made since the history index was last brought up to
+        date into it, unless there are more than limit of them. Returns the
+        number of commits read, or None if there were too many.
+        """
+
+        commitIndex = self.getCommitIndex()
+        if commitIndex is None:
+            return 0
+        with self._timings.phase('history'):
+            count = commitIndex.update(limit)
+            if count:
+                commitIndex.save()
+        self._timings.count('commits indexed', count or 0)
+        return count
+
+    def _writeItemNumbers(self, snapshots):
+        """
+        Keep the numbers of every cached item of this repository's product,
+        whichever snapshots they are in, where the commit hook can check item
+        numbers against them without reading the cache or the git
+        configuration. The first line gives the product and whether the
+        numbers are all of its items, as they are once a snapshot of every
+        assignee's items without filters has been refreshed. The file is only
+        written when it changes.
+        """
+
+        try:
+            productId = self.getConfigValue('product')
+        except KeyError:
+            return
+
+        numbers = set()
+        complete = False
+        for snapshot in snapshots:
+            if isinstance(snapshot['products'], ProductStore):
+                index = snapshot['products'].index
+            else:
+                index = snapshot.get('index', {})
+            numbers.update(index.get(productId, []))
+            if snapshot['assignee'] == 'anyone' and not snapshot['filters'] and 'refreshed_at' in snapshot and productId in index:
+                complete = True
+        if not numbers:
+            return
+        content = '%s %s\n%s\n' % (productId, 'all' if complete else 'some', ' '.join(str(number) for number in sorted(numbers)))
+
+        path = getRepoCachePath(self._sprintlyCachePath, self._repo.controldir())
+        try:
+            if open(os.path.join(path, 'items')).read() == content:
+                return
+        except IOError:
+            pass
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        writeFileAtomically(os.path.join(path, 'items'), content)
+
+    def _readCache(self):
+        """
+        Read the cache manifest from disk and return the cache; products are
+        read from disk as they are used
+        """
+
+        for path in (self._sprintlyDirectoryPath, self._sprintlyCachePath):
+            try:
+                os.mkdir(path, 0700)
+            except OSError:
+                # Already exists
+                pass
+            except IOError:
+                raise SprintlyException('Unable to create folder at %s' % path)
+
+        # Remove the single file cache used by older versions
+        try:
+            os.remove(os.path.join(self._sprintlyDirectoryPath, 'sprintly.cache'))
+        except OSError:
+            pass
+
+        cache, self._cacheStamp = self._readManifest()
+        if self._cacheStamp is not None and cache.get('version') != CACHE_VERSION:
+            # Unreadable or written by another version; ignore and replace,
+            # along with any files it refers to
+            import shutil
+            shutil.rmtree(self._sprintlyCachePath, True)
+            os.mkdir(self._sprintlyCachePath, 0700)
+            cache = {}
+            self._cacheStamp = None
+
+        return cache
+
+    def _readManifest(self):
+        """
+        Read the cache manifest from disk. Returns its contents, empty if it
+        is missing or unreadable, and the stamp of the file read.
+        """
+
+        import json
+
+        try:
+            cache_file = open(self._getManifestPath(), 'r')
+        except IOError:
+            # File doesn't exist yet
+            return {}, None
+        stamp = getFileStamp(os.fstat(cache_file.fileno()))
+        serialized_cache = cache_file.read()
+        cache_file.close()
+        try:
+            return json.loads(serialized_cache), stamp
+        except ValueError:
+            # Bad JSON; ignore and replace
+            return {}, stamp
+
+    def _getManifestPath(self):
+        return os.path.join(self._sprintlyCachePath, 'manifest.json')
+
+    def _getManifestStamp(self):
+        try:
+            return getFileStamp(os.stat(self._getManifestPath()))
+        except OSError:
+            return None
+
+    def getCache(self):
+        """
+        Get the cache from memory or from file
+        """
+
+        if self._cache is None:
+            with self._timings.phase('readCache'):
+                self._cache = self._readCache()
+        return self._cache
+
+    def sprintlyAPICall(self, url, decodeItem=None):
+        """
+        Wraps up a call to the Sprint.ly api. Returns a map representing the
+        JSON response or false if the call could not be completed. The
+        elements of an array are passed through decodeItem, if given, as they
+        arrive.
+        """
+
+        return self.getAPIClient().call(url, decodeItem)
+
+    def getAPIClient(self):
+        """
+        Get the client used to talk to the Sprint.ly API, creating it on first
+        use so that one connection and set of credentials serve the whole run.
+        """
+
+        if self._apiClient is None:
+            try:
+                baseUrl = self.getConfigValue('apiurl')
+            except KeyError:
+                baseUrl = API_URL
+            connectTimeout = self.getIntConfigValue('connecttimeout', DEFAULT_CONNECT_TIMEOUT)
+            readTimeout = self.getIntConfigValue('readtimeout', DEFAULT_READ_TIMEOUT)
+            maxInFlight = max(1, self.getIntConfigValue('concurrency', DEFAULT_CONCURRENCY))
+            retries = self.getIntConfigValue('retries', DEFAULT_RETRIES)
+            self._apiClient = SprintlyAPIClient(self.getConfigValue('user'), self.getConfigValue('key'), baseUrl, self._timings, connectTimeout, readTimeout, maxInFlight, retries)
+        return self._apiClient
+
+    def installHook(self):
+        """
+        A symlink will be created from <git repo root>/.git/hooks/commit-msg
+        to the Sprintly commit message hook.
+        If a commit message hook already exists it will be moved.
+        """
+
+        import shutil
+        import subprocess
+
+        # Ensure we are in a git repository
+        if self._repo is None:
+            raise SprintlyException('This command can only be run from a git repository.')
+
+        hooks_directory = os.path.join(self._repo.controldir(), 'hooks')
+
+        # create a symlink to the commit-msg file
+        destination = os.path.join(hooks_directory, HOOK_NAME)
+
+        # If the destination is not our hook, move it
+        if os.path.exists(destination):
+            if os.path.realpath(destination) == os.path.realpath(HOOK_PATH):
+                self.cprint('Hook is already installed.', attr=GREEN)
+                return
+            originalDestination = os.path.join(hooks_directory, ORIGINAL_HOOK_NAME)
+            if os.path.exists(originalDestination):
+                print HOOK_PATH
+                self.cprint('A commit hook (not sprintly) already exists at %s, as does where we would normally move that file, %s. This must be resolved manually.' % (destination, originalDestination), attr=RED)
+                return
+            shutil.move(destination, originalDestination)
+            self.cprint('Existing hook moved to %s' % originalDestination, attr=YELLOW)
+
+        self.cprint('Creating symlink...')
+
+        try:
+            os.symlink(HOOK_PATH, destination)
+        except Exception:
+            raise SprintlyException('Unable to create symlink.')
+
+        self.cprint('Hook was installed at %s' % destination, attr=GREEN)
+
+        # check to see if the email associated with git matches the Sprint.ly email
+        # if not, Sprint.ly won't be able to create comments
+        try:
+            process = subprocess.Popen(['git', 'config', 'user.email'], stdout=subprocess.PIPE)
+            gitEmail = process.stdout.read().strip()
+            if gitEmail != self.getConfigValue('user'):
+                self.cprint('WARNING: Your git email (' + gitEmail + ') does not match your Sprint.ly username (' + self.getConfigValue('user') + ')', attr=YELLOW)
+                self.cprint('WARNING: Don\'t worry - there is an easy fix. Simply run one of the following:', attr=YELLOW)
+                self.cprint('\t\'git config --global user.email ' + self.getConfigValue('user') + '\' (all repos)')
+                self.cprint('\t\'git config user.email ' + self.getConfigValue('user') + '\' (this repo only)')
+        except Exception:
+            self.cprint('Unable to verify that \'git config user.email\' matches your Sprint.ly account email.', attr=RED)
+
+    def uninstallHook(self):
+        """
+        Remove the symlink we created, as long as it points to our hook. If an
+        old hook was previously moved by us, move it back.
+        """
+
+        import shutil
+
+        # Ensure we are in a git repository
+        if self._repo is None:
+            raise SprintlyException('This command can only be run from a git repository.')
+
+        hooks_directory = os.path.join(self._repo.controldir(), 'hooks')
+
+        # get path to commit-msg file
+        destination = os.path.join(hooks_directory, HOOK_NAME)
+
+        # if the destination is a file, error; if it's a symlink, delete it
+        try:
+            if not os.path.exists(destination):
+                self.cprint('There is no commit hook installed.', attr=YELLOW)
+                return
+            elif not os.path.isfile(destination):
+                raise SprintlyException('Commit hook is not a file.')
+            elif os.path.realpath(destination) != os.path.realpath(HOOK_PATH):
+                raise SprintlyException('The commit-msg hook was not installed by this tool. Please remove it manually.')
+            else:
+                os.unlink(destination)
+        except SprintlyException as e:
+            raise e
+
+        self.cprint('Hook has been uninstalled.', attr=GREEN)
+
+        # If it exists, move the original hook back to commit-msg
+        originalDestination = os.path.join(hooks_directory, ORIGINAL_HOOK_NAME)
+        if os.path.exists(originalDestination):
+            shutil.move(originalDestination, destination)
+            self.cprint('Moved original commit hook back to %s' % destination, attr=YELLOW)
+
+    def setRepository(self, repo):
+        """
+        Work with the given dulwich repository, as though run inside it.
+        """
+
+        self._repo = repo
+        self._commitIndex = None
+
+    def setTerminal(self, term_stream, hasColor, cols):
+        """
+        Print to the given stream, with or without colour and for the given
+        width, rather than to the terminal found on initialization.
+        """
+
+        if hasColor != self._has_color:
+            self._templates = {}
+        self._term = self._output = term_stream
+        self._has_color = hasColor
+        self._cols = cols
+
+    def cprint(self, str, attr=None, trim=True, args=None):
+        self._term.write(self.render(str, attr, trim, args) + '\r\n')
+
+    def render(self, str, attr=None, trim=True, args=None):
+        """
+        Render a line of ${ATTR} markup for the terminal. Given args, the line
+        is a template which they are interpolated into once its markup has
+        been replaced, so they are never read as markup themselves.
+        """
+
+        seq = self.compile(str)
+        if args is not None:
+            seq = seq % args
+        if trim:
+            seq = self._trim(seq)
+
+        if self._has_color:
+            if isinstance(attr, list):
+                attr = ''.join(attr)
+            return (attr or '') + seq + RESET
+        return seq
+
+    def compile(self, template):
+        """
+        Replace the markup in a template with the terminal's escape sequences,
+        or with nothing if it has no colour, remembering the result so each
+        distinct template is only compiled once.
+        """
+
+        try:
+            return self._templates[template]
+        except KeyError:
+            if self._has_color:
+                compiled = MARKUP.sub(self._render_sub, template)
+            else:
+                compiled = MARKUP.sub('', template)
+            self._templates[template] = compiled
+            return compiled
+
+    def _render_sub(self, match):
+        s = match.group()
+        if s == '$$': return s
+        else: return ATTRS.get(s[2:-1], '')
+
+    def _trim(self, raw):
+        """
+        Truncate a rendered line to the width of the terminal, counting only
+        the characters between its escape sequences.
+        """
+
+        if len(raw) <= self._cols:
+            return raw
+
+        pieces = []
+        width = 0
+        i = 0
+        for match in ESCAPE_SEQUENCE.finditer(raw):
+            chunk = raw[i:match.start()]
+            if width + len(chunk) > self._cols:
+                break
+            pieces.append(chunk)
+            pieces.append(match.group())
+            width += len(chunk)
+            i = match.end()
+            # the line is full, with no room left for an ellipsis
+            if width >= self._cols:
+                return ''.join(pieces)
+        else:
+            chunk = raw[i:]
+            if width + len(chunk) <= self._cols:
+                pieces.append(chunk)
+                return ''.join(pieces)
+
+        pieces.append(chunk[0:max(0, self._cols - width - 1)] + u'\u2026')
+        return ''.join(pieces)
+
+    def elipsify(self, seq):
+        import string
+        return seq[0:-1].strip(string.punctuation) + u'\u2026'
+
+
+class SprintlyCommitHook:
+    def __init__(self):
+        self._sprintlyTool = None
+        self._itemNumbers = None
+        self._itemNumbersComplete = False
+        self._agentConfig = None
+        self._agentMissing = None
+
+    def getSprintlyTool(self):
+        if self._sprintlyTool is not None:
+            return self._sprintlyTool
+        self._sprintlyTool = SprintlyTool()
+
+        # the agent would have spared us that, so start it for next time
+        if self._agentMissing:
+            try:
+                if self._sprintlyTool.getConfigValue('agent').lower() in ('true', 'yes', 'on', '1'):
+                    self._sprintlyTool.startAgent()
+            except KeyError:
+                pass
+        return self._sprintlyTool
+
+    def get_config_value(self, key):
+        """
+        Get a value from the sprintly section of the git configuration, from
+        the agent if it is running or else from the sprintly tool.
+        """
+
+        if self._agentConfig is None:
+            self.ask_agent('config')
+        if self._agentConfig is not None:
+            return self._agentConfig[key]
+        return self.getSprintlyTool().getConfigValue(key)
+
+    def ask_agent(self, command):
+        """
+        Send a command to the agent for this repository and the terminal.
+        Returns the agent's answer, or None if it is not running or can't
+        answer, in which case the hook does the work itself.
+        """
+
+        if self._agentMissing:
+            return None
+
+        import json
+        import socket
+
+        # the agent renders for this terminal; curses only reads the
+        # terminal's capabilities once per process, so the agent can't tell
+        # them for each hook itself
+        columns = 80
+        color = False
+        if command == 'list' and sys.stdout.isatty():
+            import fcntl
+            import struct
+            import termios
+            from curses import setupterm, tigetnum
+            try:
+                columns = struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '    '))[1] or columns
+            except IOError:
+                pass
+            try:
+                setupterm()
+                color = tigetnum('colors') > 2
+            except Exception:
+                pass
+        request = {'command': command, 'root': os.getcwd(), 'tty': sys.stdout.isatty(), 'color': color, 'columns': columns}
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(AGENT_TIMEOUT)
+        try:
+            connection.connect(getAgentPath())
+            connection.sendall(json.dumps(request) + '\n')
+            chunks = []
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            response = json.loads(''.join(chunks))
+        except (socket.error, ValueError):
+            self._agentMissing = True
+            return None
+        finally:
+            connection.close()
+
+        self._agentMissing = False
+        if response.get('config') is not None:
+            # as the git configuration would give them, as UTF-8 strings
+            self._agentConfig = dict((key, value.encode('utf-8') if isinstance(value, unicode) else value) for key, value in response['config'].items())
+        if response.get('status') != 'ok':
+            return None
+        return response
+
+    def run(self):
+        """
+        Run the hook
+        """
+
+        try:
+            if len(sys.argv) > 1:
+                self.process(commit_msg_path=sys.argv[1])
+            else:
+                # Should never happen, but just in case...
+                raise Exception('Commit message was not received.')
+        except KeyboardInterrupt:
+            die('Program interrupted. Commit aborted.')
+        except Exception as e:
+            die('Error occurred. Commit aborted.')
+
+        # Execute the original commit hook.
+        originalDestination = os.path.join(os.path.dirname(sys.argv[0]), ORIGINAL_HOOK_NAME)
+        if os.path.exists(originalDestination):
+            import subprocess
+            subprocess.call([originalDestination, sys.argv[1]])
+
+    def process(self, commit_msg_path):
+        """
+        Process the commit message. If this method returns, it is assumed the
+        message has been validated. An Exception is the best way to exit in
+        case of error.
+        """
+
+        # read in commit message
+        commit_msg_file = open(commit_msg_path, 'r')
+        commit_msg = commit_msg_file.read().strip()
+        commit_msg_file.close()
+
+        # check to see if message is properly formatted
+        valid = self.validate_message(commit_msg)
+        if valid and len(valid) == 2:
+            new_commit_msg = valid[1]
+        else:
+
+            # let the user pick from the cached items if they would rather
+            items = False
+            if self.use_picker():
+                items = self.pick_sprintly_items()
+
+            if items is False:
+                # present sprint.ly items to user
+                self.display_sprintly_items()
+
+                # prompt user for item(s)
+                items = self.get_sprintly_items()
+
+            # check if they opted out
+            if items is None:
+                print 'Proceeding without Sprint.ly item number.'
+                return
+
+            # create new commit message
+            new_commit_msg = self.apply_template(commit_msg, items)
+
+        # save it (overwrite existing)
+        commit_msg_file = open(commit_msg_path, 'w')
+        commit_msg = commit_msg_file.write(new_commit_msg)
+        commit_msg_file.close()
+
+
+    def validate_message(self, message):
+        """
+        If the message begins with a pound and number, remove it, run it
+        through the configured template and return (True, modified message).
+
+        If the message contains (at any position) a sprint.ly action keyword
+        followed by a space, then a item keyword, then a number, accept the
+        message as is and return (True, message).
+
+        Otherwise, return false.
+        """
+
+        # Look for pound and numbers at the start of the message
+        result = re.match(r'^#(\d+(?:,#?\d+)*)\s*', message)
+        if result is not None:
+            items = [item.lstrip('#') for item in result.group(1).split(',')]
+            self.check_item_numbers(items)
+            return (True, self.apply_template(message[len(result.group(0)):], items))
+
+        # Look for any Sprintly-compatible string
+        items = findItemReferences(message)
+        if items:
+            self.check_item_numbers(items)
+            return (True, message)
+
+        return False
+
+    def apply_template(self, message, items):
+        """
+        Apply the template configured at sprintly.template to the given
+        message and items, using the item keyword configured at
+        sprintly.itemkeyword before item numbers.
+        """
+
+        if len(items) == 0:
+            raise ValueError('Expected at least one item')
+
+        try:
+            template = self.get_config_value('template')
+        except KeyError:
+            template = DEFAULT_TEMPLATE
+        try:
+            itemKeyword = self.get_config_value('itemkeyword')
+        except KeyError:
+            itemKeyword = DEFAULT_ITEM_KEYWORD
+
+        itemString = ', '.join((itemKeyword + item) for item in items)
+        return template % { 'message': message, 'items': itemString }
+
+    def display_sprintly_items(self):
+        """
+        Use the sprintly tool to display a list of sprintly items.
+
+        So as not to hold up the commit the items are shown from the cache
+        and refreshed in the background for next time. Only if the cache is
+        older than sprintly.maxstale seconds is it refreshed first. The agent,
+        if it is running, lists them from the cache it keeps ready.
+        """
+
+        response = self.ask_agent('list')
+        if response is not None:
+            sys.stdout.write(response['output'].encode('utf-8'))
+            return
+
+        sprintlyTool = self.getSprintlyTool()
+        age = sprintlyTool.getCacheAge('self')
+        if age is None or age > sprintlyTool.getIntConfigValue('maxstale', DEFAULT_MAX_STALE):
+            sprintlyTool.run(sprintlyTool.getOptions([]))
+            return
+
+        sprintlyTool.run(sprintlyTool.getOptions(['--cached']))
+        if age > BACKGROUND_REFRESH_INTERVAL:
+            sprintlyTool.refreshInBackground('self')
+
+
+    def use_picker(self):
+        """
+        Whether sprintly.picker asks for items to be picked interactively
+        rather than listed and typed in.
+        """
+
+        try:
+            return self.get_config_value('picker').lower() in ('true', 'yes', 'on', '1')
+        except KeyError:
+            return False
+
+    def pick_sprintly_items(self):
+        """
+        Let the user pick items with the interactive picker from the cached
+        items of this repository's product, first bringing the cache up to
+        date as display_sprintly_items would. Returns the picked item numbers,
+        None if the user picked none, or False if there is nothing to pick
+        from.
+        """
+
+        sprintlyTool = self.getSprintlyTool()
+        age = sprintlyTool.getCacheAge('self')
+        if age is None or age > sprintlyTool.getIntConfigValue('maxstale', DEFAULT_MAX_STALE):
+            sprintlyTool.run(sprintlyTool.getOptions(['--refresh']))
+        elif age > BACKGROUND_REFRESH_INTERVAL:
+            sprintlyTool.refreshInBackground('self')
+
+        items = sprintlyTool.getCachedItems()
+        if not items:
+            return False
+        return ItemPicker(sprintlyTool, items).pick()
+
+    def get_sprintly_items(self):
+        """
+        Ask the user until they give a list of one or more integers delimited
+        by commas and optionally whitespace. Only non-negative integers are
+        allowed. It is acceptable for integers to be preceded by a # symbol.
+        """
+
+        # enable user input
+        sys.stdin = open('/dev/tty', 'r')
+
+        warned = None
+        while True:
+            input = raw_input('Enter item numbers separated by commas, or nothing to choose no item: ')
+            if input == '':
+                return None
+            try:
+                items = map(lambda x: self.parse_item_number(x), re.split(',', input))
+            except:
+                # Try again
+                print 'Ensure item numbers are comma-separated'
+                continue
+
+            # unknown items must be entered twice
+            if input != warned and self.check_item_numbers(items):
+                print 'Enter the same again to use them anyway.'
+                warned = input
+                continue
+            return items
+
+    def check_item_numbers(self, items):
+        """
+        Warn about any of the given item numbers which are not among the
+        cached items of this repository's product, suggesting the closest
+        known numbers. Nothing is checked unless every item of the product is
+        cached. Returns the unknown item numbers.
+        """
+
+        known = self.get_item_numbers()
+        if not known or not self._itemNumbersComplete:
+            return []
+
+        unknown = [item for item in items if item not in known]
+        if unknown:
+            import difflib
+            for item in unknown:
+                matches = difflib.get_close_matches(item, known, 3)
+                suggestion = ' (did you mean %s?)' % ' or '.join('#' + match for match in matches) if matches else ''
+                print 'Warning: #%s is not one of the cached items of this product%s' % (item, suggestion)
+        return unknown
+
+    def get_item_numbers(self):
+        """
+        Get the set of cached item numbers of this repository's product, as
+        kept by the sprintly tool, which is empty if it has not kept them.
+        Whether they are all of the product's items is kept as
+        _itemNumbersComplete; otherwise they may only be the user's.
+        """
+
+        if self._itemNumbers is None:
+            path = getRepoCachePath(os.path.join(os.path.expanduser('~'), '.sprintly', 'cache'), '.git')
+            try:
+                header, numbers = (open(os.path.join(path, 'items')).read().split('\n') + [''])[:2]
+            except IOError:
+                header, numbers = '', ''
+            self._itemNumbers = set(numbers.split())
+            self._itemNumbersComplete = header.split()[1:] == ['all']
+        return self._itemNumbers
+
+
+    def parse_item_number(self, s):
+        """
+        Returns the item number from strings of format: '12', '#12'.
+        Whitespace is trimmed from the beginning and end.
+        """
+        result = re.match('^#?(\d+)$', s.strip())
+        if result is None:
+            raise ValueError
+        return result.group(1)
+
+
+class SprintlyAgent:
+    """
+    A resident process answering the commit-msg hook's requests from a Unix
+    socket, with the cache and configuration already read. It exits once
+    idle for AGENT_IDLE_TIMEOUT seconds or when this module changes.
+    """
+
+    def __init__(self, sprintlyTool):
+        """
+        Initialize instance variables.
+        """
+
+        self._tool = sprintlyTool
+        self._repos = {}
+        self._moduleStamp = self._getModuleStamp()
+
+    @staticmethod
+    def isRunning():
+        """
+        Whether an agent is listening on the socket.
+        """
+
+        import socket
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(getAgentPath())
+            return True
+        except socket.error:
+            return False
+        finally:
+            connection.close()
+
+    @staticmethod
+    def stop():
+        """
+        Ask the running agent, if any, to exit.
+        """
+
+        import json
+        import socket
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(AGENT_TIMEOUT)
+        try:
+            connection.connect(getAgentPath())
+            connection.sendall(json.dumps({'command': 'stop'}) + '\n')
+            connection.recv(65536)
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+    def serve(self):
+        """
+        Listen on the socket and answer requests until it is time to exit.
+        Returns at once if another agent is already listening.
+        """
+
+        import select
+        import socket
+
+        if self.isRunning():
+            return
+        path = getAgentPath()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0077)
+        try:
+            server.bind(path)
+            server.listen(16)
+        except socket.error:
+            # another agent started first
+            server.close()
+            return
+        finally:
+            os.umask(umask)
+
+        refreshInterval = self._tool.getIntConfigValue('agentrefresh', DEFAULT_AGENT_REFRESH)
+        nextRefresh = time() + refreshInterval
+        lastRequest = time()
+        try:
+            while True:
+                if time() >= nextRefresh:
+                    self._tool.refreshInBackground('self')
+                    nextRefresh = time() + refreshInterval
+                if time() - lastRequest > AGENT_IDLE_TIMEOUT:
+                    break
+
+                if not select.select([server], [], [], max(0, min(nextRefresh, lastRequest + AGENT_IDLE_TIMEOUT) - time()))[0]:
+                    continue
+                connection, _ = server.accept()
+                lastRequest = time()
+                connection.settimeout(AGENT_TIMEOUT)
+                try:
+                    if not self._answer(connection):
+                        break
+                except (socket.error, ValueError):
+                    pass
+                finally:
+                    connection.close()
+                if self._getModuleStamp() != self._moduleStamp:
+                    break
+        finally:
+            server.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _answer(self, connection):
+        """
+        Read a request from the connection and answer it. Returns False if the
+        agent should stop.
+        """
+
+        import json
+
+        request = connection.makefile('r').readline()
+        request = json.loads(request)
+        if request['command'] == 'stop':
+            connection.sendall(json.dumps({'status': 'stopped'}))
+            return False
+
+        response = {'status': 'unavailable', 'config': None}
+        try:
+            response = self._respond(request)
+        except (Exception, SystemExit):
+            # whatever went wrong, leave it to the hook
+            pass
+        connection.sendall(json.dumps(response))
+        return True
+
+    def _respond(self, request):
+        """
+        Get the response to a hook's request.
+        """
+
+        import dulwich.repo
+
+        tool = self._tool
+        root = os.path.realpath(request['root'])
+        if root not in self._repos:
+            self._repos[root] = dulwich.repo.Repo(root)
+        tool.setRepository(self._repos[root])
+        config = tool.getConfigValues()
+        # the hook has no use for the API key
+        response = {'status': 'ok', 'config': dict((key, value) for key, value in config.items() if key != 'key')}
+
+        if request['command'] == 'list':
+            tool.forgetChangedCache()
+            age = tool.getCacheAge('self')
+            if 'product' not in config or age is None or age > tool.getIntConfigValue('maxstale', DEFAULT_MAX_STALE):
+                # the hook prompts or refreshes first
+                return dict(response, status='unavailable')
+
+            output = BufferStream()
+            tool.setTerminal(output, request['tty'] and request.get('color', False), request['columns'])
+            tool.listSprintlyItems(tool.getOptions(['--cached']))
+            tool.writeCache()
+            response['output'] = output.getvalue()
+
+            if age > BACKGROUND_REFRESH_INTERVAL:
+                tool.refreshInBackground('self', root)
+
+        return response
+
+    def _getModuleStamp(self):
+        try:
+            return getFileStamp(os.stat(__file__))
+        except OSError:
+            return None
+
+
+class BufferStream:
+    """
+    A stream which keeps what is written to it, whether byte or unicode
+    strings, and is never a terminal.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        return u''.join(part if isinstance(part, unicode) else part.decode('utf-8') for part in self._parts)
+
+
+class SprintlyAPIClient:
+    """
+    A client for the Sprint.ly API which keeps a connection open in each
+    thread, bounds the requests in flight and retries refused ones.
+    """
+
+    def __init__(self, user, key, baseUrl=API_URL, timings=None, connectTimeout=DEFAULT_CONNECT_TIMEOUT, readTimeout=DEFAULT_READ_TIMEOUT, maxInFlight=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES):
+        """
+        Initialize instance variables.
+        """
+
+        import httplib
+        import threading
+        import urlparse
+
+        url = urlparse.urlsplit(baseUrl)
+        if url.scheme == 'https':
+            self._connectionClass = httplib.HTTPSConnection
+        elif url.scheme == 'http':
+            self._connectionClass = httplib.HTTPConnection
+        else:
+            raise SprintlyException('Unsupported API URL %s' % baseUrl)
+        self._host = url.netloc
+        self._path = url.path.rstrip('/') + '/'
+
+        self._headers = {
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Authorization': 'Basic ' + (user + ':' + key).encode('base64').replace("\n", ''),
+        }
+
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._timings = timings or NULL_TIMINGS
+        self._connectTimeout = connectTimeout
+        self._readTimeout = readTimeout
+        self._scheduler = RequestScheduler(maxInFlight)
+        self._retries = retries
+        self.deadline = None
+
+    def call(self, url, decodeItem=None):
+        """
+        Make a GET request to the given API path. Returns a map representing
+        the JSON response (which for an HTTP error is the error response,
+        with the status as its code) or false if the call could not be
+        completed. If the response is an array, each of its elements is
+        passed through decodeItem, if given, as soon as it is decoded.
+        """
+
+        return self.fetch(url, None, decodeItem)[2]
+
+    def fetch(self, url, headers=None, decodeItem=None):
+        """
+        Make a GET request to the given API path with any extra headers.
+        Returns the status code, the response headers (with lower case names)
+        and a map representing the JSON response, which is None if the
+        response has no body and false if the call could not be completed.
+        For an HTTP error the map is the error response, if it has one, and
+        always has the status as its code. The elements of an array are
+        passed through decodeItem, if given.
+        """
+
+        try:
+            status, responseHeaders, data = self.request(url, headers, decodeItem)
+        except Exception:
+            return None, {}, False
+        if status >= 400 and not (isinstance(data, dict) and 'code' in data):
+            data = dict(data if isinstance(data, dict) else {}, code=status)
+        return status, responseHeaders, data
+
+    def request(self, url, headers=None, decodeItem=None):
+        """
+        Make a GET request to the given API path with any extra headers and
+        return the status code, headers and decoded body of the response (see
+        _readBody), once there is room for it among the requests in flight.
+        A response with one of RETRY_STATUSES is retried after the pause its
+        Retry-After header asks for or, failing that, a random part of an
+        exponentially growing one, unless the pause would go past the
+        deadline; the last response is returned as it is.
+        """
+
+        import random
+
+        if headers:
+            headers = dict(self._headers, **headers)
+        else:
+            headers = self._headers
+
+        retries = 0
+        notBefore = None
+        while True:
+            self._scheduler.acquire(notBefore, self.deadline)
+            try:
+                status, responseHeaders, response = self._send(url, headers, decodeItem)
+            finally:
+                self._scheduler.release()
+            if status not in RETRY_STATUSES or retries >= self._retries:
+                break
+
+            delay = getRetryAfter(responseHeaders.get('retry-after'))
+            if status == 429:
+                self._timings.count('requests throttled')
+                self._scheduler.throttle(delay or RETRY_BACKOFF)
+            if delay is None:
+                delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** retries))
+            notBefore = time() + delay
+            if delay > RETRY_BACKOFF_MAX or self.deadline is not None and notBefore >= self.deadline:
+                break
+            retries += 1
+            self._timings.count('requests retried')
+        return status, responseHeaders, response
+
+    def _send(self, url, headers, decodeItem=None):
+        """
+        Make a GET request with the given headers and return the status code,
+        headers and decoded body of the response. If a kept-alive connection
+        turns out to have been closed by the server the request is retried
+        once on a new connection, but not if it timed out.
+        """
+
+        import httplib
+        import socket
+
+        while True:
+            timeout = self._readTimeout
+            if self.deadline is not None:
+                timeout = min(timeout, self.deadline - time())
+                if timeout <= 0:
+                    raise socket.timeout('deadline passed')
+
+            connection = self._getConnection()
+            reused = connection.sock is not None
+            started = time()
+            try:
+                if not reused:
+                    connection.timeout = min(self._connectTimeout, timeout)
+                    connection.connect()
+                connection.sock.settimeout(timeout)
+                connection.request('GET', self._path + url, headers=headers)
+                res = connection.getresponse()
+                response, size = self._readBody(res, decodeItem)
+            except (httplib.HTTPException, socket.error) as e:
+                self._timings.request(url, None, time() - started, 0)
+                self._dropConnection()
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+                raise
+            except Exception:
+                # the rest of the body is still waiting on the connection
+                self._dropConnection()
+                raise
+            self._timings.request(url, res.status, time() - started, size)
+            if res.will_close:
+                self._dropConnection()
+            return res.status, dict(res.getheaders()), response
+
+    def _readBody(self, res, decodeItem=None):
+        """
+        Read the body of a response a piece at a time, decompressing it if it
+        was sent compressed, and decode it as JSON as it arrives, so that the
+        whole of it is never held at once. Returns the decoded body, which is
+        None if it is empty and false if it isn't JSON, and the number of
+        bytes read from the connection.
+        """
+
+        import zlib
+
+        decompressor = None
+        encoding = (res.getheader('content-encoding') or 'identity').strip().lower()
+        if encoding in ('gzip', 'deflate'):
+            # either kind of header is recognized from the data itself
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        elif encoding != 'identity':
+            decompressor = False
+
+        decoder = JSONStreamDecoder(decodeItem)
+        size = 0
+        decoding = 0.0
+        while True:
+            data = res.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            if decompressor is False:
+                continue
+            started = time()
+            try:
+                if decompressor is not None:
+                    data = decompressor.decompress(data)
+                decoder.feed(data)
+            except zlib.error:
+                decompressor = False
+            decoding += time() - started
+
+        if decompressor is False:
+            return False, size
+        started = time()
+        if decompressor is not None:
+            decoder.feed(decompressor.flush())
+        response = decoder.close()
+        self._timings.add('decode', decoding + time() - started)
+        return response, size
+
+    def close(self):
+        """
+        Close the connections of all threads.
+        """
+
+        import threading
+
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def _getConnection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._connectionClass(self._host)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _dropConnection(self):
+        connection = self._local.connection
+        connection.close()
+        self._local.connection = None
+        with self._lock:
+            self._connections.remove(connection)
+
+
+class RequestScheduler:
+    """
+    Decides when each of the requests to the API made by several threads may
+    start. No more than maxInFlight run at once, and after the API refuses a
+    request for making too many, none starts until the pause it asked for is
+    over and they are spaced out at half the rate they had been starting at.
+    The spacing shrinks again with each request which goes through.
+    """
+
+    def __init__(self, maxInFlight):
+        """
+        Initialize instance variables.
+        """
+
+        import threading
+        from collections import deque
+
+        self._condition = threading.Condition()
+        self._maxInFlight = maxInFlight
+        self._inFlight = 0
+        self._starts = deque()
+        self._pausedUntil = 0
+        self._interval = 0
+        self._next = 0
+
+    def acquire(self, notBefore=None, deadline=None):
+        """
+        Wait until a request may start, and not before the time notBefore if
+        given. Raises socket.timeout, taking up no room, if that would be
+        after the deadline.
+        """
+
+        import socket
+        from time import sleep
+
+        with self._condition:
+            while self._inFlight >= self._maxInFlight:
+                self._condition.wait()
+            self._inFlight += 1
+
+            # take the next turn, and move the one after along
+            start = max(time(), self._pausedUntil, self._next, notBefore or 0)
+            self._next = start + self._interval
+
+        while True:
+            if deadline is not None and start >= deadline:
+                self.release()
+                raise socket.timeout('deadline passed')
+            if start <= time():
+                break
+            sleep(start - time())
+            start = max(start, self._pausedUntil)
+
+        # remember the last second's starts, to tell the rate from
+        with self._condition:
+            now = time()
+            self._starts.append(now)
+            while self._starts[0] < now - 1:
+                self._starts.popleft()
+
+    def release(self):
+        """
+        Make room for another request once one is done.
+        """
+
+        with self._condition:
+            self._inFlight -= 1
+            self._interval = self._interval * 0.9 if self._interval > 0.001 else 0
+            self._condition.notify()
+
+    def throttle(self, pause):
+        """
+        Hold every request back for the given number of seconds after the API
+        refused one for making too many, and halve the rate they start at.
+        """
+
+        with self._condition:
+            now = time()
+            # the other requests in flight when the first was refused are
+            # likely refused too, but they don't slow things down further
+            if now >= self._pausedUntil:
+                while self._starts and self._starts[0] < now - 1:
+                    self._starts.popleft()
+                self._interval = max(2 * self._interval, 2.0 / max(1, len(self._starts)))
+            self._pausedUntil = max(self._pausedUntil, now + pause)
+            self._next = max(self._next, self._pausedUntil)
+
+
+class JSONStreamDecoder:
+    """
+    Decodes JSON text fed to it in pieces. The elements of an array are
+    decoded as soon as each is complete, and passed through decodeItem if
+    given, so that only the text of the element still arriving is held; any
+    other value is decoded once all of it has arrived.
+    """
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, decodeItem=None):
+        """
+        Initialize instance variables.
+        """
+
+        import json
+
+        self._decoder = json.JSONDecoder()
+        self._decodeItem = decodeItem
+        self._buffer = ''
+        # None until it is known whether the text is an array
+        self._items = None
+        self._afterItem = False
+        self._ended = False
+        self._valid = True
+
+    def feed(self, data):
+        """
+        Take the next piece of the text.
+        """
+
+        buffer = self._buffer + data
+        if self._items is None:
+            start = self._whitespace.match(buffer).end()
+            if start == len(buffer) or buffer[start] != '[':
+                self._buffer = buffer
+                return
+            self._items = []
+            buffer = buffer[start + 1:]
+        elif not self._valid:
+            return
+
+        position = 0
+        while True:
+            position = self._whitespace.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if self._ended:
+                self._valid = False
+                break
+            if char == ']' and (self._afterItem or not self._items):
+                self._ended = True
+                position += 1
+                continue
+            if self._afterItem:
+                if char != ',':
+                    self._valid = False
+                    break
+                self._afterItem = False
+                position += 1
+                continue
+            try:
+                value, end = self._decoder.raw_decode(buffer, position)
+            except ValueError:
+                break
+            # a number may only be part of one which goes on in the next
+            # piece, so an element only counts once what follows is seen
+            if end == len(buffer) or buffer[end] not in ' \t\n\r,]':
+                break
+            if self._decodeItem is not None:
+                value = self._decodeItem(value)
+            self._items.append(value)
+            self._afterItem = True
+            position = end
+        self._buffer = buffer[position:]
+
+    def close(self):
+        """
+        Get the decoded value once all of the text has been fed, or None if
+        there was none and false if it wasn't JSON.
+        """
+
+        if self._items is None:
+            if not self._buffer.strip():
+                return None
+            try:
+                return self._decoder.decode(self._buffer)
+            except ValueError:
+                return False
+        if not self._valid or not self._ended:
+            return False
+        return self._items
+
+
+class ProductStore:
+    """
+    The cached products, each stored with its items in its own file so that
+    only the products used are read and only the products changed are
+    written. It behaves like a dictionary of product ID to product, and keeps
+    an index of each product's item numbers which is available without
+    reading the product.
+    """
+
+    def __init__(self, path, productIds, index):
+        """
+        Initialize instance variables.
+        """
+
+        self._path = path
+        self._productIds = list(productIds)
+        self._products = {}
+        self._changed = set()
+        self._removed = set()
+        self.index = dict((productId, index.get(productId, [])) for productId in self._productIds)
+
+    def __getitem__(self, productId):
+        if productId not in self._productIds:
+            raise KeyError(productId)
+        if productId not in self._products:
+            import json
+            try:
+                product_file = open(self._productPath(productId), 'r')
+                product = self._decode(json.loads(product_file.read()))
+                product_file.close()
+            except (IOError, ValueError, KeyError, TypeError):
+                # Missing or bad file; forget the product
+                del self[productId]
+                raise KeyError(productId)
+            self._products[productId] = product
+        return self._products[productId]
+
+    def __setitem__(self, productId, product):
+        if productId not in self._productIds:
+            self._productIds.append(productId)
+        self._products[productId] = product
+        self._changed.add(productId)
+        self._removed.discard(productId)
+        self.index[productId] = sorted(item.number for item in product['items'])
+
+    def __delitem__(self, productId):
+        if productId not in self._productIds:
+            raise KeyError(productId)
+        self._productIds.remove(productId)
+        self._products.pop(productId, None)
+        self._changed.discard(productId)
+        self._removed.add(productId)
+        del self.index[productId]
+
+    def __contains__(self, productId):
+        return productId in self._productIds
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._productIds)
+
+    def keys(self):
+        return list(self._productIds)
+
+    def values(self):
+        # a product may turn out to be unreadable and be dropped
+        return [product for product in (self.get(productId) for productId in self.keys()) if product is not None]
+
+    def get(self, productId, default=None):
+        try:
+            return self[productId]
+        except KeyError:
+            return default
+
+    def hasChanges(self):
+        """
+        Whether any product has been changed or removed since the store was
+        read or last saved.
+        """
+
+        return bool(self._changed or self._removed)
+
+    def save(self):
+        """
+        Write the products which have changed and remove the files of those
+        which have been removed.
+        """
+
+        import json
+
+        try:
+            os.makedirs(self._path, 0700)
+        except OSError:
+            # Already exists
+            pass
+
+        for productId in self._changed:
+            writeFileAtomically(self._productPath(productId), json.dumps(self._encode(self._products[productId])))
+        for productId in self._removed:
+            try:
+                os.remove(self._productPath(productId))
+            except OSError:
+                pass
+
+        self._changed = set()
+        self._removed = set()
+
+    def _productPath(self, productId):
+        return os.path.join(self._path, '%s.json' % productId)
+
+    def _encode(self, product):
+        """
+        Turn a product into its form on disk: each item is a row of its
+        fields, with its assignee and parent given by ID and number and listed
+        once each in separate tables.
+        """
+
+        people = {}
+        parents = {}
+
+        def encodeItem(item):
+            assigneeId = None
+            if item.assignee is not None:
+                assigneeId = item.assignee.id
+                people[assigneeId] = [assigneeId, item.assignee.first_name, item.assignee.last_name]
+            parentNumber = None
+            if item.parent is not None:
+                parentNumber = item.parent.number
+                if parentNumber not in parents:
+                    parents[parentNumber] = encodeItem(item.parent)
+            return [item.number, item.title, item.type, item.status, assigneeId, parentNumber, item.lastModified]
+
+        data = dict(product, items=[encodeItem(item) for item in product['items']])
+        data['parents'] = parents.values()
+        data['people'] = people.values()
+        return data
+
+    def _decode(self, data):
+        """
+        Turn a product read from disk back into its form in memory.
+        """
+
+        people = dict((personId, Person.get(personId, first_name, last_name)) for personId, first_name, last_name in data.pop('people'))
+
+        def decodeItem(row, parents):
+            number, title, type, status, assigneeId, parentNumber, lastModified = row
+            return Item(number, title, type, status, people.get(assigneeId), parents.get(parentNumber), lastModified)
 
-        # Execute the original commit hook.
-        originalDestination = os.path.join(os.path.dirname(sys.argv[0]), ORIGINAL_HOOK_NAME)
-        if os.path.exists(originalDestination):
-            subprocess.call([originalDestination, sys.argv[1]])
+        parents = {}
+        for row in data.pop('parents'):
+            parents[row[0]] = decodeItem(row, {})
+        data['items'] = [decodeItem(row, parents) for row in data['items']]
+        return data
 
-    def process(self, commit_msg_path):
+
+class CommitIndex:
+    """
+    The item numbers referenced by the commits reachable from HEAD of a git
+    repository, by commit messages as the commit-msg hook would accept them:
+    for each item, the IDs and times of the commits which reference it, the
+    most recent first. It is kept on disk with the commit it was brought up
+    to date for, so that after a commit, an amendment or a switch of branch
+    only the commits which HEAD has gained or lost since are read, however
+    long the history.
+    """
+
+    def __init__(self, path, repo):
         """
-        Process the commit message. If this method returns, it is assumed the
-        message has been validated. An Exception is the best way to exit in
-        case of error.
+        Read the index kept at path for the given dulwich repository.
         """
 
-        # read in commit message
-        commit_msg_file = open(commit_msg_path, 'r')
-        commit_msg = commit_msg_file.read().strip()
-        commit_msg_file.close()
+        import json
 
-        # check to see if message is properly formatted
-        valid = self.validate_message(commit_msg)
-        if valid and len(valid) == 2:
-            new_commit_msg = valid[1]
+        self._path = path
+        self._repo = repo
+        self._tip = None
+        self.items = {}
+        try:
+            index_file = open(path, 'r')
+            data = json.loads(index_file.read())
+            index_file.close()
+            self._tip = str(data['tip']) if data['tip'] is not None else None
+            self.items = dict((int(number), [[str(commitId), commitTime] for commitId, commitTime in commits]) for number, commits in data['items'].items())
+        except (IOError, ValueError, KeyError, TypeError):
+            # Missing or bad file; start again
+            self._tip = None
+            self.items = {}
+
+    def update(self, limit=None):
+        """
+        Bring the index up to date with HEAD, reading the commits reachable
+        from HEAD but not from the commit it was last brought up to date for,
+        and forgetting those reachable from that commit but no longer from
+        HEAD, unless there are more than limit of them together, in which
+        case the index is left as it was. Returns the number of commits read,
+        or None if there were too many.
+        """
+
+        try:
+            head = self._repo.head()
+        except KeyError:
+            # no commits yet
+            head = None
+        if head == self._tip:
+            return 0
+        if head is None:
+            self._tip = None
+            self.items = {}
+            return 0
+
+        # without the commit it was brought up to date for, start again
+        tip = self._tip
+        if tip is not None and tip not in self._repo.object_store:
+            tip = None
+            self.items = {}
+
+        maxEntries = limit + 1 if limit else None
+        added = [entry.commit for entry in self._repo.get_walker(include=[head], exclude=[tip] if tip else [], max_entries=maxEntries)]
+        removed = []
+        if tip is not None:
+            removed = [entry.commit.id for entry in self._repo.get_walker(include=[tip], exclude=[head], max_entries=maxEntries)]
+        if limit and len(added) + len(removed) > limit:
+            return None
+
+        removed = set(removed)
+        if removed:
+            for number, commits in self.items.items():
+                commits = [commit for commit in commits if commit[0] not in removed]
+                if commits:
+                    self.items[number] = commits
+                else:
+                    del self.items[number]
+
+        # the walk gives the most recent first; of commits made in the same
+        # second, those read now are the nearer to HEAD
+        gained = {}
+        for commit in added:
+            for number in set(findItemReferences(commit.message)):
+                gained.setdefault(int(number), []).append([commit.id, commit.commit_time])
+        for number, commits in gained.items():
+            self.items[number] = sorted(commits + self.items.get(number, []), key=lambda commit: -commit[1])
+
+        self._tip = head
+        return len(added) + len(removed)
+
+    def save(self):
+        """
+        Write the index to disk.
+        """
+
+        import json
+
+        directory = os.path.dirname(self._path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        writeFileAtomically(self._path, json.dumps({'tip': self._tip, 'items': self.items}))
+
+
+class Person(object):
+    """
+    A Sprint.ly user, as an item's assignee. There is only one instance for
+    each user, however many items are assigned to them.
+    """
+
+    __slots__ = ('id', 'first_name', 'last_name')
+
+    _people = {}
+
+    def __init__(self, id, first_name, last_name):
+        """
+        Initialize instance variables.
+        """
+
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+
+    @classmethod
+    def get(cls, id, first_name, last_name):
+        """
+        Get the instance for the user with the given ID.
+        """
+
+        person = cls._people.get(id)
+        if person is None:
+            person = cls._people.setdefault(id, cls(id, first_name, last_name))
+        person.first_name = first_name
+        person.last_name = last_name
+        return person
+
+    @classmethod
+    def fromAPI(cls, data):
+        """
+        Get the instance for a user as given by the API, or None for no user.
+        """
+
+        if data is None:
+            return None
+        return cls.get(data['id'], data['first_name'], data['last_name'])
+
+
+class Item(object):
+    """
+    The parts of a Sprint.ly item which are used here: much smaller than the
+    item as given by the API, which also includes its product, the full
+    details of its assignee and of its parent and more.
+    """
+
+    __slots__ = ('number', 'title', 'type', 'status', 'assignee', 'parent', 'lastModified')
+
+    # the few distinct types and statuses are shared between items
+    _strings = {}
+
+    def __init__(self, number, title, type, status, assignee, parent=None, lastModified=None):
+        """
+        Initialize instance variables. The parent of a child item is also an
+        Item, though it may not be complete.
+        """
+
+        self.number = number
+        self.title = title
+        self.type = self._strings.setdefault(type, type)
+        self.status = self._strings.setdefault(status, status)
+        self.assignee = assignee
+        self.parent = parent
+        self.lastModified = lastModified
+
+    @classmethod
+    def fromAPI(cls, data):
+        """
+        Make an item from an item as given by the API.
+        """
+
+        parent = data.get('parent')
+        if parent is not None:
+            parent = cls.fromAPI(parent)
+        return cls(data['number'], data['title'], data['type'], data['status'], Person.fromAPI(data.get('assigned_to')), parent, data.get('last_modified'))
+
+
+class ItemsTree:
+    """
+    Folds items into a tree of parent items, each with its children, as they
+    arrive and in any order. A child whose parent is not among the items is
+    put under its parent as the child refers to it. The given items are not
+    modified.
+    """
+
+    def __init__(self, items=()):
+        """
+        Initialize instance variables and add any given items.
+        """
+
+        self._parents = {} # allow parents to be looked up by number
+        self._children = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        """
+        Add an item to the tree. A 'parent' is any item without a parent, a
+        'child' is any item with a parent.
+        """
+
+        # if item is not a child
+        if item.parent is None:
+            self._parents[item.number] = item
+
+        # if item is a child...
         else:
+            number = item.parent.number
 
-            # present sprint.ly items to user
-            self.display_sprintly_items()
+            # if we don't have the parent, add placeholder parent to preserve tree structure
+            if number not in self._parents:
+                self._parents[number] = item.parent
 
-            # prompt user for item(s)
-            items = self.get_sprintly_items()
+            self._children.setdefault(number, []).append(item)
 
-            # check if they opted out
-            if items is None:
-                print 'Proceeding without Sprint.ly item number.'
-                return
+    def getTree(self):
+        """
+        Get the list of parents, each paired with its list of children ordered
+        by number, most recent first.
+        """
 
-            # create new commit message
-            new_commit_msg = self.apply_template(commit_msg, items)
+        itemsTree = []
+        for number, item in self._parents.items():
+            children = self._children.get(number, [])
+            children.sort(key=lambda child: child.number, reverse=True)
+            itemsTree.append((item, children))
 
-        # save it (overwrite existing)
-        commit_msg_file = open(commit_msg_path, 'w')
-        commit_msg = commit_msg_file.write(new_commit_msg)
-        commit_msg_file.close()
+        # sort items by first child, if it exists, else number
+        itemsTree.sort(key=lambda (item, children): (children[0].number if children else item.number, item.number), reverse=True)
+        return itemsTree
 
 
-    def validate_message(self, message):
+class TitleIndex:
+    """
+    An index of items by the trigrams of the words of their numbers and
+    titles, for fuzzy searches fast enough to run at every key press. Each
+    word is padded with two spaces in front, so that a query matches the
+    words it is the start of as fully as those it is the whole of.
+    """
+
+    def __init__(self, items):
+        """
+        Index the given items, most recent first.
         """
-        If the message begins with a pound and number, remove it, run it
-        through the configured template and return (True, modified message).
 
-        If the message contains (at any position) a sprint.ly action keyword
-        followed by a space, then a item keyword, then a number, accept the
-        message as is and return (True, message).
+        self.items = sorted(items, key=lambda item: item.number, reverse=True)
+        self._postings = {}
+        for i, item in enumerate(self.items):
+            text = u'%d %s' % (item.number, item.title)
+            for trigram in set(self._trigrams(text) + self._ends(text)):
+                self._postings.setdefault(trigram, []).append(i)
 
-        Otherwise, return false.
+    def search(self, query, limit):
+        """
+        Find the items sharing at least two thirds of the query's trigrams.
+        Matching whole words rather than the start of them ranks an item
+        higher. Returns up to limit of them, the best matches first and then
+        the most recent, and how many there are in all.
         """
 
-        # Look for pound and numbers at the start of the message
-        result = re.match(r'^#(\d+(?:,#?\d+)*)\s*', message)
-        if result is not None:
-            return (True, self.apply_template(message[len(result.group(0)):], result.group(1).split(',')))
+        import heapq
 
-        # Look for any Sprintly-compatible string
-        regex = re.compile(
-                r'\b' # word break
-                '(?:' + '|'.join(re.escape(kw) for kw in ACTION_KEYWORDS) + ')' # action keyword
-                ' ' # space
-                '(?:' + '|'.join(re.escape(kw) for kw in ITEM_KEYWORDS) + ')' # item keyword
-                r'\d+' # number
-                r'\b' # word break
-                )
-        if regex.search(message.lower()) is not None:
-            return (True, message)
+        trigrams = set(self._trigrams(query))
+        if not trigrams:
+            return self.items[:limit], len(self.items)
 
-        return False
+        scores = {}
+        for trigram in trigrams:
+            for i in self._postings.get(trigram, ()):
+                scores[i] = scores.get(i, 0) + 1
 
-    def apply_template(self, message, items):
+        threshold = (len(trigrams) * 2 + 2) // 3
+        matches = [i for i, score in scores.iteritems() if score >= threshold]
+
+        for trigram in set(self._ends(query)) - trigrams:
+            for i in self._postings.get(trigram, ()):
+                if i in scores:
+                    scores[i] += 1
+
+        best = heapq.nsmallest(limit, matches, key=lambda i: (-scores[i], i))
+        return [self.items[i] for i in best], len(matches)
+
+    @staticmethod
+    def _trigrams(text):
+        trigrams = []
+        for word in text.lower().split():
+            word = u'  ' + word.lstrip('#')
+            trigrams.extend(word[i:i + 3] for i in range(len(word) - 2))
+        return trigrams
+
+    @staticmethod
+    def _ends(text):
+        return [(u'  ' + word.lstrip('#'))[-2:] + u' ' for word in text.lower().split()]
+
+
+class ItemPicker:
+    """
+    Pick items interactively on the terminal. Typing searches the items'
+    numbers and titles, up and down (or ctrl-p and ctrl-n) move between the
+    matches, tab selects or deselects one, enter picks those selected (or
+    else the highlighted one) and escape picks none.
+    """
+
+    ROWS = 10
+
+    def __init__(self, sprintlyTool, items):
+        self._tool = sprintlyTool
+        self._index = TitleIndex(items)
+
+    def pick(self):
         """
-        Apply the template configured at sprintly.template to the given
-        message and items, using the item keyword configured at
-        sprintly.itemkeyword before item numbers.
+        Run the picker until the user is done. Returns the picked item
+        numbers, in the order they were selected, or None if none were.
         """
 
-        if len(items) == 0:
-            raise ValueError('Expected at least one item')
+        import termios
+        import tty
 
-        sprintlyTool = self.getSprintlyTool()
+        fd = os.open('/dev/tty', os.O_RDWR)
+        saved = termios.tcgetattr(fd)
         try:
-            template = sprintlyTool.getConfigValue('template')
-        except KeyError:
-            template = DEFAULT_TEMPLATE
-        try:
-            itemKeyword = sprintlyTool.getConfigValue('itemkeyword')
-        except KeyError:
-            itemKeyword = DEFAULT_ITEM_KEYWORD
+            tty.setcbreak(fd)
+            picked = self._run(fd)
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+            os.close(fd)
+
+        if not picked:
+            return None
+        print 'Picked %s' % ', '.join('#%d' % number for number in picked)
+        return [str(number) for number in picked]
+
+    def _run(self, fd):
+        query = u''
+        current = 0
+        selected = []
+        while True:
+            matches, total = self._index.search(query, self.ROWS)
+            current = max(0, min(current, len(matches) - 1))
+            self._draw(fd, query, matches, total, current, selected)
+
+            key = self._readKey(fd)
+            if key in ('\r', '\n'):
+                self._clear(fd)
+                if selected:
+                    return selected
+                return [matches[current].number] if matches else []
+            elif key == '\x1b':
+                self._clear(fd)
+                return []
+            elif key in ('\x1b[A', '\x1bOA', '\x10'):
+                current -= 1
+            elif key in ('\x1b[B', '\x1bOB', '\x0e'):
+                current += 1
+            elif key == '\t':
+                if matches:
+                    number = matches[current].number
+                    if number in selected:
+                        selected.remove(number)
+                    else:
+                        selected.append(number)
+                    current += 1
+            elif key in ('\x7f', '\x08'):
+                query = query[:-1]
+                current = 0
+            elif key == '\x15':
+                query = u''
+                current = 0
+            elif key >= ' ' and not key.startswith('\x1b'):
+                query += key.decode('utf-8', 'replace')
+                current = 0
+
+    def _draw(self, fd, query, matches, total, current, selected):
+        """
+        Draw the query and the matches below it, leaving the cursor after the
+        query.
+        """
 
-        itemString = ', '.join((itemKeyword + item) for item in items)
-        return template % { 'message': message, 'items': itemString }
+        tool = self._tool
+        lines = [tool.render('${BOLD}>${NORMAL} %s${GREY}  %d of %d%s', args=(query, total, len(self._index.items), ', %d selected' % len(selected) if selected else ''))]
+        for i, item in enumerate(matches):
+            template = '%%s%%s ${%s}#%%d${DEFAULT} %%s' % ITEM_COLORS.get(item.type)
+            lines.append(tool.render(template, attr=INVERT if i == current else None, args=('>' if i == current else ' ', '*' if item.number in selected else ' ', item.number, item.title)))
 
-    def display_sprintly_items(self):
+        output = '\r\x1b[J' + '\r\n'.join(line.encode('utf-8') for line in lines)
+        if len(lines) > 1:
+            output += '\x1b[%dA' % (len(lines) - 1)
+        output += '\r\x1b[%dC' % (len(query) + 2)
+        os.write(fd, output)
+
+    def _clear(self, fd):
+        os.write(fd, '\r\x1b[J')
+
+    def _readKey(self, fd):
         """
-        Use the sprintly tool to display a list of sprintly items.
+        Read a key press: a character, whole if it takes several bytes, or an
+        escape sequence, which arrives all at once where escape alone doesn't.
         """
 
-        sprintlyTool = self.getSprintlyTool()
-        sprintlyTool.run(sprintlyTool.getOptions([]))
+        import select
 
+        key = os.read(fd, 1)
+        if key == '\x1b':
+            if select.select([fd], [], [], 0.05)[0]:
+                key += os.read(fd, 2)
+        elif key >= '\xc0':
+            key += os.read(fd, 1 if key < '\xe0' else 2 if key < '\xf0' else 3)
+        return key
 
-    def get_sprintly_items(self):
+
+class Timings:
+    """
+    A record of how long each phase of a run took, of the latency and size of
+    each API request and of counts of what happened to the cached products.
+    Phases may be nested and may run in several threads at once, so their
+    times can add up to more than the whole run's.
+    """
+
+    enabled = True
+
+    def __init__(self, summary=True, logPath=None):
         """
-        Ask the user until they give a list of one or more integers delimited
-        by commas and optionally whitespace. Only non-negative integers are
-        allowed. It is acceptable for integers to be preceded by a # symbol.
+        Start recording; when finished, print a summary to standard error
+        and/or append a line of JSON to the file at logPath.
         """
 
-        # enable user input
-        sys.stdin = open('/dev/tty', 'r')
+        import threading
 
-        while True:
-            input = raw_input('Enter item numbers separated by commas, or nothing to choose no item: ')
-            if input == '':
-                return None
-            try:
-                return map(lambda x: self.parse_item_number(x), re.split(',', input))
-            except:
-                # Try again
-                print 'Ensure item numbers are comma-separated'
-                pass
+        self._lock = threading.Lock()
+        self._started = time()
+        self._summary = summary
+        self._logPath = logPath
+        self.phases = {}
+        self.requests = []
+        self.counts = {}
 
+    def phase(self, name):
+        """
+        Get a context manager timing a phase of the given name.
+        """
 
-    def parse_item_number(self, s):
+        return TimedPhase(self, name)
+
+    def add(self, name, seconds):
+        with self._lock:
+            calls, total = self.phases.get(name, (0, 0.0))
+            self.phases[name] = (calls + 1, total + seconds)
+
+    def request(self, url, status, seconds, size):
+        with self._lock:
+            self.requests.append((url, status, seconds, size))
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def finish(self):
         """
-        Returns the item number from strings of format: '12', '#12'.
-        Whitespace is trimmed from the beginning and end.
+        Report what was recorded, once.
         """
-        result = re.match('^#?(\d+)$', s.strip())
-        if result is None:
-            raise ValueError
-        return result.group(1)
+
+        elapsed = time() - self._started
+        if self._summary:
+            self._printSummary(elapsed)
+            self._summary = False
+        if self._logPath:
+            self._appendLog(elapsed)
+            self._logPath = None
+
+    def _printSummary(self, elapsed):
+        lines = ['Timings: %.1f ms in all' % (elapsed * 1000)]
+        for name, (calls, total) in sorted(self.phases.items(), key=lambda (name, (calls, total)): -total):
+            lines.append('  %-16s %9.1f ms %6d call%s' % (name, total * 1000, calls, '' if calls == 1 else 's'))
+        if self.requests:
+            latencies = [seconds for url, status, seconds, size in self.requests]
+            lines.append('  %d requests, %d bytes, %.1f ms total latency, %.1f ms the slowest' % (len(self.requests), sum(size for url, status, seconds, size in self.requests), sum(latencies) * 1000, max(latencies) * 1000))
+            for url, status, seconds, size in sorted(self.requests, key=lambda request: -request[2])[:5]:
+                lines.append('    %7.1f ms %6d bytes %s %s' % (seconds * 1000, size, status, url))
+        for name, n in sorted(self.counts.items()):
+            lines.append('  %s: %d' % (name, n))
+        sys.stderr.write('\n'.join(lines) + '\n')
+
+    def _appendLog(self, elapsed):
+        import json
+
+        record = {
+            'at': self._started,
+            'argv': sys.argv,
+            'seconds': elapsed,
+            'phases': dict((name, {'calls': calls, 'seconds': total}) for name, (calls, total) in self.phases.items()),
+            'requests': [{'url': url, 'status': status, 'seconds': seconds, 'bytes': size} for url, status, seconds, size in self.requests],
+            'counts': self.counts,
+        }
+        try:
+            log = open(self._logPath, 'a')
+            log.write(json.dumps(record) + '\n')
+            log.close()
+        except IOError:
+            pass
+
+
+class TimedPhase:
+    """
+    Context manager adding the time spent inside it to a phase of a Timings.
+    """
+
+    def __init__(self, timings, name):
+        self._timings = timings
+        self._name = name
+
+    def __enter__(self):
+        self._started = time()
+
+    def __exit__(self, *exc_info):
+        self._timings.add(self._name, time() - self._started)
+
+
+class NullTimings:
+    """
+    Stands in for Timings when nothing is to be recorded, at the cost of a
+    method call or two.
+    """
+
+    enabled = False
+
+    def phase(self, name):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def add(self, name, seconds):
+        pass
+
+    def request(self, url, status, seconds, size):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def finish(self):
+        pass
+
+NULL_TIMINGS = NullTimings()
 
 
 class SprintlyException(Exception):
@@ -906,13 +3486,145 @@ class SprintlyException(Exception):
         return repr(self.value)
 
 
+def main():
+    """
+    Run the sprintly command line tool.
+    """
+
+    sprintlyTool = SprintlyTool()
+    sprintlyTool.run(sprintlyTool.getOptions())
+
+
+def getTimings():
+    """
+    Get what SPRINTLY_PROFILE asks to be recorded: a comma-separated list of
+    'summary', to print timings to standard error, and 'log', to append them
+    to ~/.sprintly/timings.log as a line of JSON (any other value means
+    'summary'). Without it, nothing is.
+    """
+
+    profile = os.environ.get('SPRINTLY_PROFILE')
+    if not profile:
+        return NULL_TIMINGS
+    profile = profile.split(',')
+    logPath = None
+    if 'log' in profile:
+        logPath = os.path.join(os.path.expanduser('~'), '.sprintly', 'timings.log')
+    return Timings('summary' in profile or logPath is None, logPath)
+
+
+def getRepoCachePath(cachePath, controlDir):
+    """
+    Get the path of the directory in the cache at cachePath holding what is
+    cached about the git repository with the given control directory.
+    """
+
+    import hashlib
+    return os.path.join(cachePath, 'repos', hashlib.md5(os.path.realpath(controlDir)).hexdigest())
+
+
+def findItemReferences(message):
+    """
+    Get the item numbers a commit message references with an action keyword,
+    as strings, in the order they appear.
+    """
+
+    return [number for match in ITEM_REFERENCE.findall(message.lower()) for number in re.findall(r'\d+', match)]
+
+
+def getAgentPath():
+    """
+    Get the path of the socket the agent listens on.
+    """
+
+    return os.path.join(os.path.expanduser('~'), '.sprintly', 'agent.sock')
+
+
+def writeFileAtomically(path, content):
+    """
+    Write a file by writing the content to a temporary file beside it and
+    renaming that over it, so that the file is only ever seen whole.
+    """
+
+    import tempfile
+
+    fd, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as temporaryFile:
+            temporaryFile.write(content)
+        os.rename(temporaryPath, path)
+    except:
+        try:
+            os.remove(temporaryPath)
+        except OSError:
+            pass
+        raise
+
+
+def getRetryAfter(value):
+    """
+    Get the number of seconds to wait which a Retry-After header gives, as
+    a number of seconds or an HTTP date, or None if it gives none.
+    """
+
+    if value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_tz, mktime_tz
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time())
+
+
+def formatAge(seconds):
+    """
+    Describe a number of seconds roughly, in the largest whole unit.
+    """
+
+    for unit, size in (('day', 24 * 60 * 60), ('hour', 60 * 60), ('minute', 60)):
+        if seconds >= size:
+            count = int(seconds // size)
+            return '%d %s%s' % (count, unit, '' if count == 1 else 's')
+    return 'less than a minute'
+
+
+def getFileStamp(stat):
+    """
+    Get what identifies the version of a file from its stat: a file
+    replaced by renaming is a different inode even if its size and
+    modification time are the same.
+    """
+
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def forceUTF8():
+    """
+    Make UTF-8 the default encoding, so that item titles can be printed
+    whatever the terminal.
+    """
+
+    if sys.getdefaultencoding() != 'utf-8':
+        stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+        reload(sys)
+        sys.setdefaultencoding('utf-8')
+        # reloading resets the standard streams
+        sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+
+
 def die(message=None, *args):
     """
     Prints the message, if present, and then exits.
     """
 
     if message:
-        logger.error(message, *args, exc_info=True)
+        import logging
+        logging.basicConfig()
+        logging.getLogger(__name__).error(message, *args, exc_info=True)
     print 'Program exiting.'
     sys.exit(1)
 